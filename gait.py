@@ -1,6 +1,7 @@
 import numpy as np
 import torch
 from torch.nn import functional as F
+import kernels
 import utils
 
 
@@ -10,50 +11,123 @@ def gait_sim_entropy(K, p, alpha=1):
     over an alphabet of n elements.
     
     Inputs:
-        K [n x n tensor] : Positive semi-definite similarity matrix
-        p [batch_size x n tensor] : Probability distributions over n elements
+        K [n x n tensor or kernels.KernelOperator] : Positive semi-definite similarity matrix
+        p [batch_size x n tensor, torch sparse or scipy sparse matrix] : Probability distributions over n elements
         alpha [float] : Divergence order
     
     Output:
         [batch_size x 1 tensor] of entropy for each distribution
     """
-    pK = p @ K
+    K = as_kernel_operator(K)
+    if _is_sparse(p):
+        return _on_supports(gait_sim_entropy, K, p, alpha=alpha)
+    pK = K.matvec(p)
+    sum_dims = _event_sum_dims(K)
 
     if np.allclose(alpha, 1.0):
-        ent = -(p * torch.log(pK)).sum(dim=-1)
+        ent = -(p * torch.log(pK)).sum(dim=sum_dims)
     else:
         Kpa = pK ** (alpha - 1)
-        v = (p * Kpa).sum(dim=-1, keepdim=True)
+        v = (p * Kpa).flatten(-K.event_dims).sum(-1, keepdim=True)
         ent = torch.log(v) / (1 - alpha)
 
     return ent
 
 
-def gait_sim_entropy_stable(log_K, p, alpha=1):
+def gait_sim_entropy_stable(log_K, p, alpha=1, tile_size=None):
     """
     Compute similarity sensitive GAIT entropy of a (batch of) distribution(s) p
     over an alphabet of n elements.
     
     Inputs:
-        log_K [n x n tensor] : Log of positive semi-definite similarity matrix
-        p [batch_size x n tensor] : Probability distributions over n elements
+        log_K [n x n tensor or kernels.KernelOperator] : Log of positive semi-definite similarity matrix
+        p [batch_size x n tensor, torch sparse or scipy sparse matrix] : Probability distributions over n elements
         alpha [float] : Divergence order
+        tile_size [int or None] : Tile size of the log-domain kernel product, see utils.log_matvec
     
     Output:
         [batch_size x 1 tensor] of entropy for each distribution
     """
-    log_pK = torch.logsumexp(log_K[None, ...] + torch.log(p[:, None, :]), dim=2)
+    log_K = as_kernel_operator(log_K, log=True, tile_size=tile_size)
+    if _is_sparse(p):
+        return _on_supports(gait_sim_entropy_stable, log_K, p, alpha=alpha)
+    log_pK = log_K.log_matvec(p)
+    sum_dims = _event_sum_dims(log_K)
 
     if np.allclose(alpha, 1.0):
-        ent = -(p * log_pK).sum(dim=-1)
+        ent = -(p * log_pK).sum(dim=sum_dims)
     else:
         log_Kpa = log_pK * (alpha - 1)
-        log_v = torch.logsumexp(torch.log(p) + log_Kpa, dim=-1, keepdim=True)
+        log_v = torch.logsumexp((torch.log(p) + log_Kpa).flatten(-log_K.event_dims), dim=-1, keepdim=True)
         ent = log_v / (1 - alpha)
 
     return ent
 
 
+def gait_sim_entropy_profile(K, p, alphas, eps=None):
+    """
+    Compute similarity sensitive GAIT entropies of a (batch of) distribution(s) p for a whole vector of orders at
+    once, reusing a single p K. Orders within eps of 1 use the second order expansion of the entropy around
+    alpha = 1, so the profile is smooth in alpha without a Python branch.
+    
+    Inputs:
+        K [n x n tensor or kernels.KernelOperator] : Positive semi-definite similarity matrix
+        p [batch_size x n tensor] : Probability distributions over n elements
+        alphas [tensor or sequence of floats] : Divergence orders
+        eps [float or None] : Distance to alpha = 1 below which the expansion is used; the cube root of the
+                              machine epsilon of p's dtype when None
+    
+    Output:
+        [batch_size x len(alphas) tensor] of entropy for each distribution and order
+    """
+    K = as_kernel_operator(K)
+    return _entropy_profile(p, torch.log(K.matvec(p)), alphas, K.event_dims, eps)
+
+
+def gait_sim_entropy_profile_stable(log_K, p, alphas, eps=None, tile_size=None):
+    """
+    Compute similarity sensitive GAIT entropies of a (batch of) distribution(s) p for a whole vector of orders at
+    once, reusing a single log(p K). See gait_sim_entropy_profile.
+    
+    Inputs:
+        log_K [n x n tensor or kernels.KernelOperator] : Log of positive semi-definite similarity matrix
+        p [batch_size x n tensor] : Probability distributions over n elements
+        alphas [tensor or sequence of floats] : Divergence orders
+        eps [float or None] : Distance to alpha = 1 below which the expansion is used, see
+                              gait_sim_entropy_profile
+        tile_size [int or None] : Tile size of the log-domain kernel product, see utils.log_matvec
+    
+    Output:
+        [batch_size x len(alphas) tensor] of entropy for each distribution and order
+    """
+    log_K = as_kernel_operator(log_K, log=True, tile_size=tile_size)
+    return _entropy_profile(p, log_K.log_matvec(p), alphas, log_K.event_dims, eps)
+
+
+def _entropy_profile(p, log_pK, alphas, event_dims, eps):
+    """
+    log(sum p (pK)^(alpha - 1)) / (1 - alpha) for every alpha. With t = alpha - 1 this is minus the cumulant
+    generating function of log pK under p divided by t, -(mean + t var / 2 + O(t^2)), which gives the alpha -> 1
+    limit. Outside the expansion -log_v / t loses about machine eps / |t| to cancellation, and the expansion is off
+    by O(t^2), so the default eps balances the two at the cube root of the machine epsilon.
+    """
+    if eps is None:
+        eps = torch.finfo(p.dtype).eps ** (1. / 3)
+    p = p.flatten(-event_dims)
+    log_pK = log_pK.flatten(-event_dims)
+    t = torch.as_tensor(alphas, dtype=p.dtype, device=p.device).reshape(-1) - 1
+    small = torch.abs(t) < eps
+    t_safe = torch.where(small, torch.ones_like(t), t)
+
+    mean = (p * log_pK).sum(-1, keepdim=True)
+    var = (p * (log_pK - mean) ** 2).sum(-1, keepdim=True)
+    log_p = torch.log(p)
+    chunk = max(1, utils.LOG_MATVEC_BUDGET // p.numel())
+    log_v = torch.cat([torch.logsumexp(log_p[..., None, :] + t_safe[i:i + chunk, None] * log_pK[..., None, :], dim=-1)
+                       for i in range(0, len(t), chunk)], -1)
+    return torch.where(small, -(mean + t * var / 2), -log_v / t_safe)
+
+
 def sim_cross_entropy(K, p, q, alpha=1, normalize=False):
     """
     TODO: this is not mathematically correct!!
@@ -62,7 +136,7 @@ def sim_cross_entropy(K, p, q, alpha=1, normalize=False):
     with respect to a (batch of) distribution(s) pover an alphabet of n elements.
     
     Inputs:
-        K [n x n tensor] : Positive semi-definite similarity matrix
+        K [n x n tensor or kernels.KernelOperator] : Positive semi-definite similarity matrix
         p [batch_size x n tensor] : Probability distributions over n elements
         q [batch_size x n tensor] : Probability distributions over n elements
         alpha [float] : Divergence order
@@ -70,9 +144,8 @@ def sim_cross_entropy(K, p, q, alpha=1, normalize=False):
     Output:
         [batch_size x 1 tensor] i-th entry is cross entropy of i-th row of q w.r.t i-th row of p 
     """
+    Kq = as_kernel_operator(K).t().matvec(q).transpose(0, 1)
     p = p.transpose(0, 1)
-    q = q.transpose(0, 1)
-    Kq = K @ q
     
     
     if normalize:
@@ -96,90 +169,467 @@ def breg_sim_divergence(K, p, q, symmetric=False):
     distribution(s) p and q over an alphabet of n elements.    Inputs:
        p [batch_size x n tensor] : Probability distributions over n elements
        q [batch_size x n tensor] : Probability distributions over n elements
-       K [n x n tensor or callable] : Positive semi-definite similarity matrix or function
+       K [n x n tensor, callable or kernels.KernelOperator] : Positive semi-definite similarity matrix or function
        symmetric [boolean]: Use symmetrized Bregman divergence.
+    p and q may also be torch sparse or scipy sparse matrices, see _on_supports.
     Output:
        div [batch_size x 1 tensor] i-th entry is divergence between i-th row of p and i-th row of q
     """
-    if symmetric:
-        r = (p + q) / 2.
-    if callable(K):
-        pK = K(p)
-        qK = K(q)
-        if symmetric:
-            rK = K(r)
-    else:
-        pK = p @ K
-        qK = q @ K
-        if symmetric:
-            rK = r @ K
-    if symmetric:
-        rat1 = (pK, rK)
-        rat2 = (qK, rK)
-    else:
-        rat1 = (pK, qK)
-
-    if callable(K):  # we're dealing with an image
-        sum_dims = (-2, -1)
-    else:
-        sum_dims = -1
-
-    if symmetric:
-        t1 = (p * (torch.log(rat1[0]) - torch.log(rat1[1]))).sum(sum_dims)
-        t2 = (r * (rat1[0] / rat1[1])).sum(sum_dims)
-        t3 = (q * (torch.log(rat2[0]) - torch.log(rat2[1]))).sum(sum_dims)
-        t4 = (r * (rat2[0] / rat2[1])).sum(sum_dims)
-        return (2 + t1 - t2 + t3 - t4) / 2.
-    else:
-        t1 = (p * (torch.log(rat1[0]) - torch.log(rat1[1]))).sum(sum_dims)
-        t2 = (q * (rat1[0] / rat1[1])).sum(sum_dims)
-        return 1 + t1 - t2
+    K = as_kernel_operator(K)
+    if _is_sparse(p) or _is_sparse(q):
+        return _on_supports(breg_sim_divergence, K, p, q, symmetric=symmetric)
+    log_pK = torch.log(K.matvec(p))
+    log_qK = torch.log(K.matvec(q))
+    return bregman_divergence(p, q, log_pK, log_qK, symmetric, K.event_dims)
 
 
-def breg_sim_divergence_stable(log_K, p, q, symmetric=False):
+def breg_sim_divergence_stable(log_K, p, q, symmetric=False, tile_size=None):
     """
     Compute similarity sensitive Bregman divergence of between a pair of (batches of)
     distribution(s) p and q over an alphabet of n elements.    Inputs:
        p [batch_size x n tensor] : Probability distributions over n elements
        q [batch_size x n tensor] : Probability distributions over n elements
-       log_K [n x n tensor or callable] : Log of positive semi-definite similarity matrix or function
+       log_K [n x n tensor, callable or kernels.KernelOperator] : Log of positive semi-definite similarity matrix
+                                                                  or function returning log(K p)
        symmetric [boolean]: Use symmetrized Bregman divergence.
+       tile_size [int or None] : Tile size of the log-domain kernel product, see utils.log_matvec
+    p and q may also be torch sparse or scipy sparse matrices, see _on_supports.
     Output:
        div [batch_size x 1 tensor] i-th entry is divergence between i-th row of p and i-th row of q
     """
-    if symmetric:
-        r = (p + q) / 2.
-    if callable(log_K):
-        log_pK = log_K(p)
-        log_qK = log_K(q)
-        if symmetric:
-            log_rK = log_K(r)
-    else:
-        log_pK = torch.logsumexp(log_K[None, ...] + torch.log(p[:, None, :]), dim=2)
-        log_qK = torch.logsumexp(log_K[None, ...] + torch.log(q[:, None, :]), dim=2)
+    log_K = as_kernel_operator(log_K, log=True, tile_size=tile_size)
+    if _is_sparse(p) or _is_sparse(q):
+        return _on_supports(breg_sim_divergence_stable, log_K, p, q, symmetric=symmetric)
+    return _breg_divergence_from_log(log_K, p, q, log_K.log_matvec(p), symmetric=symmetric)
+
+
+def _breg_divergence_from_log(log_K, p, q, log_pK, symmetric=False):
+    """
+    q-dependent half of breg_sim_divergence_stable, given log(p K) and the kernels.KernelOperator log_K.
+    """
+    return bregman_divergence(p, q, log_pK, log_K.log_matvec(q), symmetric, log_K.event_dims)
+
+
+class BregmanDivergence(torch.autograd.Function):
+    """
+    Similarity sensitive Bregman divergence of (batches of) distributions p and q over a common alphabet of N
+    elements, from log(p K) and log(q K), all [batch_size x N]. The symmetric version uses r = (p + q) / 2 and
+    log(r K) = logaddexp(log(p K), log(q K)) - log 2, so it needs no third kernel product. The backward pass is
+    closed form and only the four inputs are saved.
+    With mixture=True, p [batch_size x n] and q [batch_size x m] live on the first n and last m atoms of a joint
+    alphabet of N = n + m elements, and the terms of the (never built) zero-padded [p, 0] and [0, q] are skipped.
+    """
+
+    @staticmethod
+    def forward(ctx, p, q, log_pK, log_qK, symmetric=False, mixture=False):
+        ctx.save_for_backward(p, q, log_pK, log_qK)
+        ctx.symmetric = symmetric
+        ctx.mixture = mixture
+        ys, xs = _mixture_slices(p, mixture)
         if symmetric:
-            log_rK = torch.logsumexp(log_K[None, ...] + torch.log(r[:, None, :]), dim=2)
-    if symmetric:
-        rat1 = (log_pK, log_rK)
-        rat2 = (log_qK, log_rK)
-    else:
-        rat1 = (log_pK, log_qK)
+            # r exp(log pK - log rK) + r exp(log qK - log rK) = 2 r, which sums to the masses of p and q
+            log_rK = torch.logaddexp(log_pK, log_qK) - np.log(2)
+            return (2 + (p * (log_pK[..., ys] - log_rK[..., ys] - 1)).sum(-1)
+                    + (q * (log_qK[..., xs] - log_rK[..., xs] - 1)).sum(-1)) / 2.
+        return 1 + (p * (log_pK[..., ys] - log_qK[..., ys])).sum(-1) \
+            - (q * torch.exp(log_pK[..., xs] - log_qK[..., xs])).sum(-1)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        p, q, log_pK, log_qK = ctx.saved_tensors
+        grad_out = grad_out[..., None]
+        if ctx.mixture:
+            grads = _mixture_breg_gradients(p, q, log_pK, log_qK, ctx.symmetric)
+        elif ctx.symmetric:
+            log_rK = torch.logaddexp(log_pK, log_qK) - np.log(2)
+            r = (p + q) / 2.
+            a = log_pK - log_rK
+            b = log_qK - log_rK
+            grads = (a - 1) / 2., (b - 1) / 2., (p - r * torch.exp(a)) / 2., (q - r * torch.exp(b)) / 2.
+        else:
+            diff = log_pK - log_qK
+            ratio = torch.exp(diff)
+            grad_log_pK = p - q * ratio
+            grads = diff, -ratio, grad_log_pK, -grad_log_pK
+        return tuple((grad_out * g).sum_to_size(x.shape) if needed else None
+                     for g, x, needed in zip(grads, ctx.saved_tensors, ctx.needs_input_grad)) + (None, None)
+
+
+def _mixture_slices(p, mixture):
+    """
+    Slices of the joint alphabet holding p and q: the first n and last m atoms of a mixture, or all of it.
+    """
+    if not mixture:
+        return slice(None), slice(None)
+    n = p.size(-1)
+    return slice(None, n), slice(n, None)
 
-    if callable(log_K):  # we're dealing with an image
-        sum_dims = (-2, -1)
-    else:
-        sum_dims = -1
 
+def _mixture_breg_gradients(p, q, log_pK, log_qK, symmetric):
+    """
+    Gradients of BregmanDivergence with mixture=True with respect to p, q, log(p K) and log(q K).
+    """
+    n = p.size(-1)
     if symmetric:
-        t1 = (p * (rat1[0] - rat1[1])).sum(sum_dims)
-        t2 = (r * torch.exp(rat1[0] - rat1[1])).sum(sum_dims)
-        t3 = (q * (rat2[0] - rat2[1])).sum(sum_dims)
-        t4 = (r * torch.exp(rat2[0] - rat2[1])).sum(sum_dims)
-        return (2 + t1 - t2 + t3 - t4) / 2.
+        log_rK = torch.logaddexp(log_pK, log_qK) - np.log(2)
+        a = log_pK - log_rK
+        b = log_qK - log_rK
+        ea = torch.exp(a) / 4.
+        eb = torch.exp(b) / 4.
+        return ((a[..., :n] - 1) / 2., (b[..., n:] - 1) / 2.,
+                _join(p * (.5 - ea[..., :n]), -q * ea[..., n:]), _join(-p * eb[..., :n], q * (.5 - eb[..., n:])))
+    ratio = torch.exp(log_pK[..., n:] - log_qK[..., n:])
+    grad_log_pK = _join(p, -q * ratio)
+    return log_pK[..., :n] - log_qK[..., :n], -ratio, grad_log_pK, -grad_log_pK
+
+
+def _join(y, x):
+    """
+    [y, x] along the last dimension, broadcasting the leading dimensions.
+    """
+    shape = torch.broadcast_shapes(y.shape[:-1], x.shape[:-1])
+    return torch.cat([y.expand(shape + y.shape[-1:]), x.expand(shape + x.shape[-1:])], -1)
+
+
+def bregman_divergence(p, q, log_pK, log_qK, symmetric=False, event_dims=1):
+    """
+    BregmanDivergence over the last event_dims dimensions of p, q, log(p K) and log(q K).
+    Output:
+        div [batch_size tensor]
+    """
+    return BregmanDivergence.apply(p.flatten(-event_dims), q.flatten(-event_dims), log_pK.flatten(-event_dims),
+                                   log_qK.flatten(-event_dims), symmetric)
+
+
+class DivergenceTarget:
+    """
+    Similarity sensitive Bregman divergence from a fixed reference (batch of) distribution(s) p, for optimisation
+    loops in which only q changes. log(p K) is computed once, treating p and K as constants, and reused until
+    either is modified in place or replaced (detected by the tensors' version counters).
+    """
+
+    def __init__(self, log_K, p, symmetric=False, tile_size=None):
+        """
+        Inputs:
+            log_K [n x n tensor, callable or kernels.KernelOperator] : Log of positive semi-definite similarity
+                                                                       matrix or function, as in
+                                                                       breg_sim_divergence_stable
+            p [batch_size x n tensor] : Reference probability distributions over n elements
+            symmetric [boolean]: Use symmetrized Bregman divergence.
+            tile_size [int or None] : Tile size of the log-domain kernel product, see utils.log_matvec
+        """
+        self.log_K = log_K
+        self.p = p
+        self.symmetric = symmetric
+        self.tile_size = tile_size
+        self._key = None
+        self._log_pK = None
+
+    def log_pK(self):
+        key = (_state_key(self.log_K), _state_key(self.p))
+        if key != self._key:
+            with torch.no_grad():
+                self._log_pK = as_kernel_operator(self.log_K, log=True, tile_size=self.tile_size).log_matvec(self.p)
+            self._key = key
+        return self._log_pK
+
+    def divergence(self, q):
+        """
+        Inputs:
+            q [batch_size x n tensor] : Probability distributions over n elements
+        Output:
+            div [batch_size x 1 tensor] i-th entry is divergence between i-th row of p and i-th row of q
+        """
+        log_K = as_kernel_operator(self.log_K, log=True, tile_size=self.tile_size)
+        return _breg_divergence_from_log(log_K, self.p, q, self.log_pK(), symmetric=self.symmetric)
+
+
+class MixtureTarget:
+    """
+    Mixture divergence breg_mixture_divergence_stable(p, Y, q, X, log_kernel) from a fixed empirical measure p
+    with support Y, for optimisation loops in which only q and its atoms X move. log(K_yy p) is computed once,
+    treating p and Y as constants, and reused until p, Y, log_Kyy or log_kernel is modified in place or replaced
+    (including a change of the kernel's parameters, such as its bandwidth), so each step costs O(nm + m^2) rather
+    than O((n+m)^2).
+    """
+
+    def __init__(self, p, Y, log_kernel, symmetric=False, tile_size=None, log_Kyy=None):
+        """
+        Inputs:
+            p [1 x n tensor] : Probability distribution over n elements
+            Y [n x d tensor] : Locations of the atoms of the measure p
+            log_kernel [callable] : Function to compute the log kernel matrix, or a kernel with a fused
+                                    log_matvec(X, Y, log_q) such as kernels.RBFLogKernel
+            symmetric [boolean] : Use the symmetric version of the divergence
+            tile_size [int or None] : Tile size of the log-domain kernel product, see utils.log_matvec
+            log_Kyy [n x n tensor or None] : Precomputed log_kernel(Y, Y)
+        """
+        self.p = p
+        self.Y = Y
+        self.log_kernel = log_kernel
+        self.symmetric = symmetric
+        self.tile_size = tile_size
+        self.log_Kyy = log_Kyy
+        self._key = None
+        self._log_pK = None
+
+    def log_pK(self):
+        """
+        log(K_yy p) [1 x n tensor] over the atoms Y.
+        """
+        key = (_state_key(self.p), _state_key(self.Y), _state_key(self.log_Kyy), _state_key(self.log_kernel))
+        if key != self._key:
+            with torch.no_grad():
+                log_p = torch.log(self.p)
+                if self.log_Kyy is not None:
+                    self._log_pK = utils.log_matvec(self.log_Kyy, log_p, self.tile_size)
+                elif hasattr(self.log_kernel, 'log_matvec'):
+                    self._log_pK = self.log_kernel.log_matvec(self.Y, self.Y, log_p)
+                else:
+                    self._log_pK = utils.log_matvec(self.log_kernel(self.Y, self.Y), log_p, self.tile_size)
+            self._key = key
+        return self._log_pK
+
+    def divergence(self, q, X):
+        """
+        Inputs:
+            q [1 x m tensor] : Probability distribution over m elements
+            X [m x d tensor] : Locations of the atoms of the measure q
+        Output:
+            div [1 x 1 tensor] similarity sensitive divergence between p and q
+        """
+        p, Y = self.p, self.Y
+        log_p, log_q = torch.log(p), torch.log(q)
+        if hasattr(self.log_kernel, 'log_matvec'):
+            log_pK_x = self.log_kernel.log_matvec(X, Y, log_p)
+            log_qK = torch.cat([self.log_kernel.log_matvec(Y, X, log_q), self.log_kernel.log_matvec(X, X, log_q)], -1)
+        else:
+            log_Kxy = self.log_kernel(X, Y)
+            log_pK_x = utils.log_matvec(log_Kxy, log_p, self.tile_size)
+            log_qK = torch.cat([utils.log_matvec(log_Kxy.t(), log_q, self.tile_size),
+                                utils.log_matvec(self.log_kernel(X, X), log_q, self.tile_size)], -1)
+        log_pK = torch.cat([self.log_pK(), log_pK_x], -1)
+        return _mixture_breg_divergence(p, q, log_pK, log_qK, symmetric=self.symmetric)
+
+
+class DivergenceWorkspace:
+    """
+    Reusable buffers for evaluating divergences many times with the same shapes, as in an evaluation loop. Buffers
+    are keyed on (name, shape, dtype, device) and only allocated on first use; buffers_allocated counts them.
+    Under torch.no_grad, log(p), log(q), the kernel products and the divergence are written into the buffers, so
+    the returned tensor and the intermediates keep their storage from call to call; the returned tensor is
+    overwritten by the next call. This holds for dense and point cloud log kernels, and for callable log kernels
+    or kernels with a fused log_matvec in mixtures; their kernel blocks and the tiles of streamed products are
+    still temporaries. Other kernel operators and low-rank features allocate their products, which are then
+    combined in place.
+    With gradients enabled autograd keeps the tensors it saves, so the workspace falls back to
+    breg_sim_divergence_stable and breg_mixture_divergence_stable, only reusing the zero padding of kernel
+    operators.
+    """
+
+    def __init__(self, symmetric=False, tile_size=None):
+        self.symmetric = symmetric
+        self.tile_size = tile_size
+        self.buffers_allocated = 0
+        self._buffers = {}
+
+    def buffer(self, name, shape, dtype, device):
+        key = name, tuple(shape), dtype, device
+        if key not in self._buffers:
+            self._buffers[key] = torch.empty(shape, dtype=dtype, device=device)
+            self.buffers_allocated += 1
+        return self._buffers[key]
+
+    def zeros(self, like):
+        key = 'zeros', tuple(like.shape), like.dtype, like.device
+        if key not in self._buffers:
+            return self.buffer(*key).zero_()
+        return self._buffers[key]
+
+    def divergence(self, log_K, p, q):
+        """
+        breg_sim_divergence_stable(log_K, p, q, self.symmetric, self.tile_size) for dense p and q.
+        """
+        if torch.is_grad_enabled():
+            return breg_sim_divergence_stable(log_K, p, q, self.symmetric, self.tile_size)
+        log_K = as_kernel_operator(log_K, log=True, tile_size=self.tile_size)
+        batch_size = p.size(0)
+        return self._combine(p.reshape(batch_size, -1), q.reshape(batch_size, -1),
+                             self._log_matvec(log_K, p, 'p'), self._log_matvec(log_K, q, 'q'))
+
+    def mixture_divergence(self, p, Y, q, X, log_kernel):
+        """
+        breg_mixture_divergence_stable(p, Y, q, X, log_kernel, self.symmetric, self.tile_size).
+        """
+        if torch.is_grad_enabled():
+            padded = None
+            if isinstance(log_kernel, kernels.KernelOperator):
+                padded = self._padded(p, q)
+            log_pK, log_qK = _mixture_log_products(p, Y, q, X, log_kernel, self.tile_size, padded)
+            return _mixture_breg_divergence(p, q, log_pK, log_qK, self.symmetric)
+        if isinstance(log_kernel, kernels.KernelOperator):
+            P, Q = self._padded(p, q)
+            log_pK, log_qK = self._log_matvec(log_kernel, P, 'p'), self._log_matvec(log_kernel, Q, 'q')
+        elif hasattr(log_kernel, 'features'):
+            log_pK, log_qK = _low_rank_mixture_products(p, Y, q, X, log_kernel)
+        else:
+            log_pK, log_qK = self._mixture_log_products(p, Y, q, X, log_kernel)
+        return self._combine(p, q, log_pK, log_qK, mixture=True)
+
+    def _log_matvec(self, K, p, name):
+        """
+        log(p K) [batch_size x N] for the kernels.KernelOperator K, written into a buffer along with log(p) for
+        dense and point cloud log kernels.
+        """
+        batch_size = p.size(0)
+        if (isinstance(K, kernels.DenseKernel) and K.log_K is not None) or isinstance(K, kernels.PointCloudKernel):
+            p = p.reshape(batch_size, -1)
+            log_p = torch.log(p, out=self.buffer('log_' + name, p.shape, p.dtype, p.device))
+            out = self.buffer('log_%sK' % name, p.shape, p.dtype, p.device)
+            if isinstance(K, kernels.DenseKernel):
+                return utils.log_matvec(K.log_K.t(), log_p, K.tile_size, out)
+            return kernels.fused_log_kernel_matvec(K.log_kernel, K.Y, K.X, log_p, K.tile_size, out)
+        return K.log_matvec(p).reshape(batch_size, -1)
+
+    def _mixture_log_products(self, p, Y, q, X, log_kernel):
+        """
+        _mixture_log_products for callable log kernels and kernels with a fused log_matvec, writing the blocks of
+        log(K [p, 0]) and log(K [0, q]) into the halves of buffers rather than concatenating them.
+        """
+        n = p.size(-1)
+        shape = p.shape[:-1] + (n + q.size(-1),)
+        log_p = torch.log(p, out=self.buffer('log_p', p.shape, p.dtype, p.device))
+        log_q = torch.log(q, out=self.buffer('log_q', q.shape, q.dtype, q.device))
+        log_pK = self.buffer('log_pK', shape, p.dtype, p.device)
+        log_qK = self.buffer('log_qK', shape, q.dtype, q.device)
+        if hasattr(log_kernel, 'log_matvec'):
+            log_kernel.log_matvec(Y, Y, log_p, out=log_pK[..., :n])
+            log_kernel.log_matvec(X, Y, log_p, out=log_pK[..., n:])
+            log_kernel.log_matvec(Y, X, log_q, out=log_qK[..., :n])
+            log_kernel.log_matvec(X, X, log_q, out=log_qK[..., n:])
+            return log_pK, log_qK
+        log_Kyx = log_kernel(Y, X)
+        utils.log_matvec(log_kernel(Y, Y), log_p, self.tile_size, log_pK[..., :n])
+        utils.log_matvec(log_Kyx.t(), log_p, self.tile_size, log_pK[..., n:])
+        utils.log_matvec(log_Kyx, log_q, self.tile_size, log_qK[..., :n])
+        utils.log_matvec(log_kernel(X, X), log_q, self.tile_size, log_qK[..., n:])
+        return log_pK, log_qK
+
+    def _padded(self, p, q):
+        """
+        Zero-padded [p, 0] and [0, q] over the joint alphabet, written into buffers under torch.no_grad.
+        """
+        if torch.is_grad_enabled():
+            return torch.cat([p, self.zeros(q)], -1), torch.cat([self.zeros(p), q], -1)
+        n = p.size(-1)
+        shape = p.shape[:-1] + (n + q.size(-1),)
+        P = self.buffer('P', shape, p.dtype, p.device).zero_()
+        Q = self.buffer('Q', shape, q.dtype, q.device).zero_()
+        P[..., :n].copy_(p)
+        Q[..., n:].copy_(q)
+        return P, Q
+
+    def _combine(self, p, q, log_pK, log_qK, mixture=False):
+        """
+        In-place BregmanDivergence(p, q, log_pK, log_qK, self.symmetric, mixture) from [batch_size x N] kernel
+        products.
+        """
+        ys, xs = _mixture_slices(p, mixture)
+        shape, dtype, device = log_pK.shape, log_pK.dtype, log_pK.device
+        a = self.buffer('a', shape, dtype, device)
+        out = self.buffer('out', shape[:-1], dtype, device)
+        t = self.buffer('t', shape[:-1], dtype, device)
+        if not self.symmetric:
+            torch.sub(log_pK, log_qK, out=a)
+            tmp = self.buffer('tmp', a[..., ys].shape, dtype, device)
+            torch.sum(torch.mul(a[..., ys], p, out=tmp), -1, out=out)
+            torch.sum(a[..., xs].exp_().mul_(q), -1, out=t)
+            return out.sub_(t).add_(1)
+        # (2 + sum p (log pK - log rK - 1) + sum q (log qK - log rK - 1)) / 2, as in BregmanDivergence
+        b = self.buffer('b', shape, dtype, device)
+        log_rK = torch.logaddexp(log_pK, log_qK, out=self.buffer('log_rK', shape, dtype, device)).sub_(np.log(2))
+        torch.sub(log_pK, log_rK, out=a)
+        torch.sub(log_qK, log_rK, out=b)
+        torch.sum(a[..., ys].sub_(1).mul_(p), -1, out=out)
+        out.add_(torch.sum(b[..., xs].sub_(1).mul_(q), -1, out=t))
+        return out.add_(2).div_(2)
+
+
+def _state_key(obj):
+    """
+    Identity and version counters of a tensor, or identity and attributes of a kernel (tensors by version counter,
+    numbers, strings and sequences of them by value), to detect changes such as a new bandwidth.
+    """
+    if isinstance(obj, torch.Tensor):
+        return id(obj), obj._version
+    if obj is None:
+        return None
+    return id(obj), tuple((name, _attribute_key(v)) for name, v in getattr(obj, '__dict__', {}).items())
+
+
+def _attribute_key(value):
+    """
+    Value of a plain attribute for _state_key; other objects are only compared by identity.
+    """
+    if isinstance(value, torch.Tensor):
+        return id(value), value._version
+    if value is None or isinstance(value, (bool, int, float, str, np.number)):
+        return value
+    if isinstance(value, np.ndarray):
+        return value.shape, value.tobytes()
+    if isinstance(value, (list, tuple)):
+        return tuple(_attribute_key(v) for v in value)
+    if isinstance(value, dict):
+        return tuple((k, _attribute_key(v)) for k, v in value.items())
+    return id(value)
+
+
+def pairwise_breg_divergence(K, P, Q=None, symmetric=False, block_size=None):
+    """
+    Compute the matrix of similarity sensitive Bregman divergences between every distribution in P and every
+    distribution in Q, computing P K and Q K only once. The non-symmetric divergence is assembled from two
+    matrix products; the symmetric one, whose rK depends on the pair, is evaluated in blocks of rows of P.
+    Inputs:
+       K [n x n tensor, callable or kernels.KernelOperator] : Positive semi-definite similarity matrix or function
+       P [N x n tensor] : Probability distributions over n elements
+       Q [M x n tensor or None] : Probability distributions over n elements, P if None
+       symmetric [boolean]: Use symmetrized Bregman divergence.
+       block_size [int or None] : Rows of P per block of the symmetric divergence; chosen from
+                                  utils.LOG_MATVEC_BUDGET when None
+    Output:
+       div [N x M tensor] (i, j)-th entry is divergence between i-th row of P and j-th row of Q
+    """
+    K = as_kernel_operator(K)
+    N = P.size(0)
+    PK = K.matvec(P).reshape(N, -1)
+    if Q is None:
+        Q, QK = P, PK
     else:
-        t1 = (p * (rat1[0] - rat1[1])).sum(sum_dims)
-        t2 = (q * torch.exp(rat1[0] - rat1[1])).sum(sum_dims)
-        return 1 + t1 - t2
+        QK = K.matvec(Q).reshape(Q.size(0), -1)
+    P = P.reshape(N, -1)
+    Q = Q.reshape(Q.size(0), -1)
+    log_PK = torch.log(PK)
+    log_QK = torch.log(QK)
+
+    if not symmetric:
+        t1 = (P * log_PK).sum(-1, keepdim=True)
+        return 1 + t1 - P @ log_QK.t() - PK @ (Q / QK).t()
+
+    if block_size is None:
+        block_size = max(1, utils.LOG_MATVEC_BUDGET // Q.numel())
+    res = []
+    for i0 in range(0, N, block_size):
+        rows = slice(i0, i0 + block_size)
+        p, pK, log_pK = P[rows, None, :], PK[rows, None, :], log_PK[rows, None, :]
+        r = (p + Q[None, ...]) / 2.
+        rK = (pK + QK[None, ...]) / 2.
+        log_rK = torch.log(rK)
+        t1 = (p * (log_pK - log_rK)).sum(-1)
+        t2 = (r * (pK / rK)).sum(-1)
+        t3 = (Q[None, ...] * (log_QK[None, ...] - log_rK)).sum(-1)
+        t4 = (r * (QK[None, ...] / rK)).sum(-1)
+        res.append((2 + t1 - t2 + t3 - t4) / 2.)
+    return torch.cat(res, 0)
 
 
 def breg_mixture_divergence(p, Y, q, X, kernel, symmetric=False):
@@ -192,24 +642,35 @@ def breg_mixture_divergence(p, Y, q, X, kernel, symmetric=False):
         Y [n x d tensor] : Locations of the atoms of the measure p
         q [1 x m tensor] : Probability distribution over m elements
         X [n x d tensor] : Locations of the atoms of the measure q
-        kernel [callable] : Function to compute the kernel matrix
+        kernel [callable] : Function to compute the kernel matrix, a low-rank approximation with
+                            features(Y, X) such as kernels.NystromKernel, or a kernels.KernelOperator over
+                            the joint alphabet [Y; X]
         symmetric [boolean] : Use the symmetric version of the divergence
     Output:
         div [1 x 1 tensor] similarity sensitive divergence of between mu and nu
     """
+    if isinstance(kernel, kernels.KernelOperator):
+        pK = kernel.matvec(torch.cat([p, torch.zeros_like(q)], -1))
+        qK = kernel.matvec(torch.cat([torch.zeros_like(p), q], -1))
+        return _mixture_breg_divergence(p, q, torch.log(pK), torch.log(qK), symmetric=symmetric)
+
+    if hasattr(kernel, 'features'):
+        log_pK, log_qK = _low_rank_mixture_products(p, Y, q, X, kernel)
+        return _mixture_breg_divergence(p, q, log_pK, log_qK, symmetric=symmetric)
 
     Kyy = kernel(Y, Y)
     Kyx = kernel(Y, X)
     Kxx = kernel(X, X)
 
-    f_p = torch.cat([p, torch.zeros_like(q)], -1)
-    f_q = torch.cat([torch.zeros_like(p), q], -1)
-    f_K = torch.cat([torch.cat([Kyy, Kyx], 1), torch.cat([Kyx.t(), Kxx], 1)], 0)
+    # p and q live on disjoint halves of the joint alphabet [Y; X], so K @ [p, 0] and K @ [0, q] only touch
+    # the blocks in the corresponding columns; the (n+m) x (n+m) matrix is never assembled.
+    pK = torch.cat([p @ Kyy, p @ Kyx], -1)
+    qK = torch.cat([q @ Kyx.t(), q @ Kxx], -1)
 
-    return breg_sim_divergence(f_K, f_p, f_q, symmetric=symmetric)
+    return _mixture_breg_divergence(p, q, torch.log(pK), torch.log(qK), symmetric=symmetric)
 
 
-def breg_mixture_divergence_stable(p, Y, q, X, log_kernel, symmetric=False):
+def breg_mixture_divergence_stable(p, Y, q, X, log_kernel, symmetric=False, tile_size=None):
     """
     Compute similarity sensitive GAIT divergence of between a pair of empirical distributions
     p and q with supports Y and X, respectively
@@ -218,42 +679,157 @@ def breg_mixture_divergence_stable(p, Y, q, X, log_kernel, symmetric=False):
         Y [n x d tensor] : Locations of the atoms of the measure p
         q [1 x m tensor] : Probability distribution over m elements
         X [n x d tensor] : Locations of the atoms of the measure q
-        log_kernel [callable] : Function to compute the log kernel matrix
+        log_kernel [callable] : Function to compute the log kernel matrix, a kernel with a fused
+                                log_matvec(X, Y, log_q) such as kernels.RBFLogKernel, a low-rank
+                                approximation with features(Y, X) such as kernels.NystromKernel, or a
+                                kernels.KernelOperator over the joint alphabet [Y; X]
         symmetric [boolean] : Use the symmetric version of the divergence
+        tile_size [int or None] : Tile size of the log-domain kernel product, see utils.log_matvec
     Output:
         div [1 x 1 tensor] similarity sensitive divergence of between mu and nu
     """
+    log_pK, log_qK = _mixture_log_products(p, Y, q, X, log_kernel, tile_size)
+    return _mixture_breg_divergence(p, q, log_pK, log_qK, symmetric=symmetric)
+
+
+def breg_mixture_divergences(ps, Zs, log_kernel, pairs, symmetric=False, log=True, tile_size=None):
+    """
+    Compute several similarity sensitive GAIT divergences between empirical distributions, as combined by unbiased
+    estimators, evaluating the kernel only once on the concatenated supports Z = [Z_0; Z_1; ...]. Each log(K p_i)
+    over all of Z is a block row-sum of that kernel, and every divergence reads its two blocks from those, giving
+    the same values and gradients as separate calls to breg_mixture_divergence(_stable).
+    Inputs:
+        ps [list of 1 x n_i tensors] : Probability distributions
+        Zs [list of n_i x d tensors] : Locations of the atoms of each measure
+        log_kernel [callable] : Function to compute the (log) kernel matrix; kernels with a fused
+                                log_matvec(X, Y, log_q) or low-rank features(*supports) are used as in
+                                breg_mixture_divergence_stable
+        pairs [list of (int, int)] : Pairs (i, j), each asking for the divergence between ps[i] and ps[j]
+        symmetric [boolean] : Use the symmetric version of the divergence
+        log [boolean] : log_kernel returns the log kernel matrix rather than the kernel matrix
+        tile_size [int or None] : Tile size of the log-domain kernel product, see utils.log_matvec
+    Output:
+        div [len(pairs) x 1 tensor] similarity sensitive divergence for each pair
+    """
+    offsets = np.cumsum([0] + [Z.size(0) for Z in Zs])
+    used = sorted(set(i for pair in pairs for i in pair))
+    Z = torch.cat(Zs, 0)
+    if hasattr(log_kernel, 'features'):
+        log_pKs = dict(zip(used, _low_rank_log_products(log_kernel, Zs, [ps[i] if i in used else None
+                                                                        for i in range(len(Zs))])))
+    elif log and hasattr(log_kernel, 'log_matvec'):
+        log_pKs = {i: log_kernel.log_matvec(Z, Zs[i], torch.log(ps[i])) for i in used}
+    else:
+        log_K = log_kernel(Z, Z) if log else torch.log(log_kernel(Z, Z))
+        log_pKs = {i: utils.log_matvec(log_K[:, offsets[i]:offsets[i + 1]], torch.log(ps[i]), tile_size) for i in used}
+
+    def blocks(log_pK, i, j):
+        return torch.cat([log_pK[..., offsets[i]:offsets[i + 1]], log_pK[..., offsets[j]:offsets[j + 1]]], -1)
+
+    return torch.stack([_mixture_breg_divergence(ps[i], ps[j], blocks(log_pKs[i], i, j), blocks(log_pKs[j], i, j),
+                                                 symmetric=symmetric) for i, j in pairs])
+
+
+def _mixture_log_products(p, Y, q, X, log_kernel, tile_size=None, padded=None):
+    """
+    log(K [p, 0]) and log(K [0, q]) over the joint alphabet [Y; X], see breg_mixture_divergence_stable. padded
+    optionally supplies the zero-padded [p, 0] and [0, q] used by kernel operators.
+    """
+    if isinstance(log_kernel, kernels.KernelOperator):
+        if padded is None:
+            padded = torch.cat([p, torch.zeros_like(q)], -1), torch.cat([torch.zeros_like(p), q], -1)
+        return log_kernel.log_matvec(padded[0]), log_kernel.log_matvec(padded[1])
+
+    if hasattr(log_kernel, 'features'):
+        return _low_rank_mixture_products(p, Y, q, X, log_kernel)
+
+    log_p = torch.log(p)
+    log_q = torch.log(q)
+
+    if hasattr(log_kernel, 'log_matvec'):
+        log_pK = torch.cat([log_kernel.log_matvec(Y, Y, log_p), log_kernel.log_matvec(X, Y, log_p)], -1)
+        log_qK = torch.cat([log_kernel.log_matvec(Y, X, log_q), log_kernel.log_matvec(X, X, log_q)], -1)
+        return log_pK, log_qK
 
     log_Kyy = log_kernel(Y, Y)
     log_Kyx = log_kernel(Y, X)
     log_Kxx = log_kernel(X, X)
 
-    f_p = torch.cat([p, torch.zeros_like(q)], -1)
-    f_q = torch.cat([torch.zeros_like(p), q], -1)
-    f_log_K = torch.cat([torch.cat([log_Kyy, log_Kyx], 1), torch.cat([log_Kyx.t(), log_Kxx], 1)], 0)
+    log_pK = torch.cat([utils.log_matvec(log_Kyy, log_p, tile_size),
+                        utils.log_matvec(log_Kyx.t(), log_p, tile_size)], -1)
+    log_qK = torch.cat([utils.log_matvec(log_Kyx, log_q, tile_size),
+                        utils.log_matvec(log_Kxx, log_q, tile_size)], -1)
+    return log_pK, log_qK
 
-    return breg_sim_divergence_stable(f_log_K, f_p, f_q, symmetric=symmetric)
 
+def _low_rank_mixture_products(p, Y, q, X, kernel):
+    """
+    log(K [p, 0]) and log(K [0, q]) over the joint alphabet [Y; X] from low-rank features, in O((n+m) r).
+    """
+    return tuple(_low_rank_log_products(kernel, [Y, X], [p, q]))
+
+
+def _low_rank_log_products(kernel, supports, dists):
+    """
+    log(K p_i) over the concatenated supports for every distribution p_i (or None to skip it) on supports[i],
+    from low-rank features sharing one draw. Positive random features stay in the log domain through
+    log_features, so that features underflowing for atoms of large norm do not turn log(K p) into -inf.
+    """
+    if getattr(kernel, 'positive', False) and hasattr(kernel, 'log_features'):
+        log_Phis = kernel.log_features(*supports)
+        log_Phi = torch.cat(log_Phis, 0)
+        return [utils.log_matvec(log_Phi, utils.log_matvec(log_Phi_i.t(), torch.log(p)))
+                for p, log_Phi_i in zip(dists, log_Phis) if p is not None]
+    Phis = kernel.features(*supports)
+    Phi = torch.cat(Phis, 0)
+    return [torch.log(utils.clamp_positive((p @ Phi_i) @ Phi.t())) for p, Phi_i in zip(dists, Phis) if p is not None]
+
+
+def _mixture_breg_divergence(p, q, log_pK, log_qK, symmetric=False):
+    """
+    Bregman divergence of breg_sim_divergence on the joint alphabet [Y; X] of a mixture, where p is supported on
+    the first n atoms and q on the last m atoms. BregmanDivergence reads the blocks of log_pK and log_qK it needs,
+    so the terms of the zero-padded [p, 0] and [0, q] are skipped rather than multiplied by zero.
+    Inputs:
+        p [1 x n tensor] : Probability distribution over the atoms Y
+        q [1 x m tensor] : Probability distribution over the atoms X
+        log_pK [1 x (n+m) tensor] : log(K [p, 0]) over the joint alphabet
+        log_qK [1 x (n+m) tensor] : log(K [0, q]) over the joint alphabet
+        symmetric [boolean] : Use the symmetric version of the divergence
+    Output:
+        div [1 x 1 tensor] similarity sensitive divergence of between mu and nu
+    """
+    return BregmanDivergence.apply(p, q, log_pK, log_qK, symmetric, True)
 
-def test_mixture_divergence(p, Y, q, X, log_kernel, symmetric=False, use_avg=False):
+
+def test_mixture_divergence(p, Y, q, X, log_kernel, symmetric=False, use_avg=False, tile_size=None):
     """
     Inputs:
         p [1 x n tensor] : Probability distribution over n elements
         Y [n x d tensor] : Locations of the atoms of the measure p
         q [1 x m tensor] : Probability distribution over m elements
         X [n x d tensor] : Locations of the atoms of the measure q
-        log_kernel [callable] : Function to compute the log kernel matrix
+        log_kernel [callable or kernels.KernelOperator] : Function to compute the log kernel matrix, or a kernel
+                                                          operator over the joint alphabet [Y; X]
+        tile_size [int or None] : Tile size of the log-domain kernel product, see utils.log_matvec
     Output:
         div [1 x 1 tensor] similarity sensitive divergence of between mu and nu
     """
-    log_Kyy = log_kernel(Y, Y)
-    log_Kyx = log_kernel(Y, X)
-    log_Kxx = log_kernel(X, X)
+    if isinstance(log_kernel, kernels.KernelOperator):
+        n = p.size(1)
+        log_K = torch.log(log_kernel.to_dense())
+        log_Kyy, log_Kyx, log_Kxx = log_K[:n, :n], log_K[:n, n:], log_K[n:, n:]
+    else:
+        log_Kyy = log_kernel(Y, Y)
+        log_Kyx = log_kernel(Y, X)
+        log_Kxx = log_kernel(X, X)
 
-    log_Kyy_p = torch.logsumexp(log_Kyy + torch.log(p), dim=1, keepdim=True).transpose(0, 1)
-    log_Kxy_p = torch.logsumexp(log_Kyx.transpose(0, 1) + torch.log(p), dim=1, keepdim=True).transpose(0, 1)
-    log_Kyx_q = torch.logsumexp(log_Kyx + torch.log(q), dim=1, keepdim=True).transpose(0, 1)
-    log_Kxx_q = torch.logsumexp(log_Kxx + torch.log(q), dim=1, keepdim=True).transpose(0, 1)
+    log_p = torch.log(p)
+    log_q = torch.log(q)
+    log_Kyy_p = utils.log_matvec(log_Kyy, log_p, tile_size)
+    log_Kxy_p = utils.log_matvec(log_Kyx.transpose(0, 1), log_p, tile_size)
+    log_Kyx_q = utils.log_matvec(log_Kyx, log_q, tile_size)
+    log_Kxx_q = utils.log_matvec(log_Kxx, log_q, tile_size)
 
     log_K = torch.cat([torch.cat([log_Kyy, log_Kyx], dim=1), torch.cat([log_Kyx.transpose(0, 1), log_Kxx], dim=1)],
                       dim=0)
@@ -276,8 +852,140 @@ def test_mixture_divergence(p, Y, q, X, log_kernel, symmetric=False, use_avg=Fal
 
     return div
 
-def cosine_similarity(X, Y, log=False):
-    ret = utils.batch_cosine_similarity(X, Y)
+def as_kernel_operator(K, log=False, tile_size=None):
+    """
+    Wrap a similarity matrix or function in a kernels.KernelOperator; operators are returned unchanged.
+    Inputs:
+        K [n x n tensor, callable or kernels.KernelOperator] : Similarity matrix, or function computing p K
+        log [boolean] : K is the log similarity matrix, or a function computing log(p K)
+        tile_size [int or None] : Tile size of the log-domain kernel product, see utils.log_matvec
+    Output:
+        [kernels.KernelOperator]
+    """
+    if isinstance(K, kernels.KernelOperator):
+        return K
+    if callable(K):  # we're dealing with an image
+        return kernels.CallableKernel(log_fn=K) if log else kernels.CallableKernel(fn=K)
+    if log:
+        return kernels.DenseKernel(log_K=K, tile_size=tile_size)
+    return kernels.DenseKernel(K, tile_size=tile_size)
+
+
+def _event_sum_dims(K):
+    return tuple(range(-K.event_dims, 0)) if K.event_dims > 1 else -1
+
+
+def _is_sparse(p):
+    return getattr(p, 'is_sparse', False) or hasattr(p, 'tocsr')
+
+
+def _support_rows(p, dtype, device):
+    """
+    (indices, values) of the non-zero entries of every row of a dense tensor, torch sparse or scipy sparse
+    matrix p [batch_size x n]. Values of dense rows keep their autograd history.
+    """
+    if hasattr(p, 'tocsr'):
+        p = p.tocsr()
+        return [(torch.as_tensor(p.indices[a:b], dtype=torch.long, device=device),
+                 torch.as_tensor(p.data[a:b], dtype=dtype, device=device))
+                for a, b in zip(p.indptr[:-1], p.indptr[1:])]
+    if p.is_sparse:
+        p = p.coalesce()
+        rows, cols = p.indices()
+        counts = torch.bincount(rows, minlength=p.size(0)).tolist()
+        return list(zip(torch.split(cols, counts), torch.split(p.values(), counts)))
+    return [(row.nonzero()[:, 0], row[row != 0]) for row in p]
+
+
+def _on_supports(fn, K, *dists, **kwargs):
+    """
+    Evaluate fn(K, *dists) row by row over the union of the supports of the rows of dists only, with K
+    restricted to those elements, so that sparse distributions over a large alphabet never get densified.
+    Inputs:
+        fn [callable] : Entropy or divergence function taking the kernel and dense distributions
+        K [kernels.KernelOperator] : Kernel over a one dimensional alphabet of n elements
+        dists [batch_size x n tensors, torch sparse or scipy sparse matrices] : Probability distributions
+    Output:
+        [batch_size (x 1) tensor] fn of each row, shaped as fn returns it
+    """
+    dtype = K.dtype or torch.get_default_dtype()
+    res = []
+    for row in zip(*[_support_rows(p, dtype, K.device) for p in dists]):
+        support = torch.unique(torch.cat([index for index, _ in row]))
+        sub = [torch.zeros(len(support), dtype=dtype, device=support.device).index_put(
+            (torch.searchsorted(support, index),), values.to(dtype))[None] for index, values in row]
+        res.append(fn(K.restrict(support), *sub, **kwargs))
+    return torch.cat(res, 0)
+
+
+def rbf_sweep_entropy(X, p, sigmas, alpha=1, degree=2, dist=None, chunk_size=None):
+    """
+    Compute similarity sensitive GAIT entropies of a (batch of) distribution(s) p over the atoms X under the RBF
+    kernel exp(-(d / sigma)^degree) for a whole vector of bandwidths, computing the pairwise distances only once.
+    Bandwidths are evaluated in batched chunks.
+    Inputs:
+        X [n x d tensor] : Locations of the atoms
+        p [batch_size x n tensor] : Probability distributions over n elements
+        sigmas [tensor or sequence of floats] : Bandwidths
+        alpha [float] : Divergence order
+        degree [float] : Exponent of the RBF kernel
+        dist [n x n tensor or None] : Precomputed pairwise distances between the atoms
+        chunk_size [int or None] : Bandwidths per chunk; chosen from utils.LOG_MATVEC_BUDGET when None
+    Output:
+        [len(sigmas) x batch_size tensor] of entropy for each bandwidth and distribution
+    """
+    if dist is None:
+        dist = utils.batch_pdist(X, X)
+    res = []
+    for log_K in _rbf_sweep_log_kernels(dist, sigmas, degree, chunk_size, p.size(0)):
+        log_pK = torch.logsumexp(log_K[:, None, ...] + torch.log(p)[None, :, None, :], dim=-1)
+        res.append(_entropy_profile(p, log_pK, [alpha], 1, None)[..., 0])
+    return torch.cat(res, 0)
+
+
+def rbf_sweep_mixture_divergence(p, Y, q, X, sigmas, symmetric=False, degree=2, dist=None, chunk_size=None):
+    """
+    Compute similarity sensitive GAIT divergences between the empirical distributions p and q with supports Y and
+    X under the RBF kernel exp(-(d / sigma)^degree) for a whole vector of bandwidths, computing the pairwise
+    distances of the joint support [Y; X] only once.
+    Inputs:
+        p [1 x n tensor] : Probability distribution over n elements
+        Y [n x d tensor] : Locations of the atoms of the measure p
+        q [1 x m tensor] : Probability distribution over m elements
+        X [m x d tensor] : Locations of the atoms of the measure q
+        sigmas [tensor or sequence of floats] : Bandwidths
+        symmetric [boolean] : Use the symmetric version of the divergence
+        degree [float] : Exponent of the RBF kernel
+        dist [(n+m) x (n+m) tensor or None] : Precomputed pairwise distances of the joint support [Y; X]
+        chunk_size [int or None] : Bandwidths per chunk; chosen from utils.LOG_MATVEC_BUDGET when None
+    Output:
+        div [len(sigmas) x 1 tensor] similarity sensitive divergence for each bandwidth
+    """
+    if dist is None:
+        Z = torch.cat([Y, X], 0)
+        dist = utils.batch_pdist(Z, Z)
+    n = p.size(-1)
+    res = []
+    for log_K in _rbf_sweep_log_kernels(dist, sigmas, degree, chunk_size):
+        log_pK = torch.logsumexp(log_K[..., :n] + torch.log(p), dim=-1)[:, None, :]
+        log_qK = torch.logsumexp(log_K[..., n:] + torch.log(q), dim=-1)[:, None, :]
+        res.append(_mixture_breg_divergence(p, q, log_pK, log_qK, symmetric=symmetric))
+    return torch.cat(res, 0)
+
+
+def _rbf_sweep_log_kernels(dist, sigmas, degree, chunk_size, batch_size=1):
+    """
+    Yield chunks [chunk x n x m] of the log RBF kernels of the pairwise distances dist for every bandwidth.
+    """
+    sigmas = torch.as_tensor(sigmas, dtype=dist.dtype, device=dist.device).reshape(-1)
+    if chunk_size is None:
+        chunk_size = max(1, utils.LOG_MATVEC_BUDGET // (dist.numel() * batch_size))
+    for i in range(0, len(sigmas), chunk_size):
+        yield -(dist[None, ...] / sigmas[i:i + chunk_size, None, None]) ** degree
+
+
+def cosine_similarity(X, Y, log=False, normalized=False, chunk_size=None):
+    ret = utils.batch_cosine_similarity(X, Y, normalized, chunk_size)
     if log:
         return torch.log(ret)
     else:
@@ -290,21 +998,15 @@ def poly_kernel(X, Y, degree=2, c=1, p=2, log=False):
     else:
         return utils.min_clamp_prob(1 / (1 + c * pdist)**degree)
     
-def rbf_kernel(X, Y, sigmas=[1.], p=2, degree=2, log=False):
-    pdist = utils.batch_pdist(X, Y, p)
-    res = torch.zeros_like(pdist)
-    if log:
-        log_res = torch.zeros_like(pdist)
-    for sigma in sigmas:
-        logits = - (pdist/sigma)**degree
-        res += torch.exp(logits)
-        if log:
-            log_res += logits
-    ret = res / len(sigmas)
+def rbf_kernel(X, Y, sigmas=[1.], p=2, degree=2, log=False, weights=None):
+    if p == 2:
+        log_res = kernels.rbf_log_mixture(utils.batch_sqdist(X, Y), sigmas, degree, weights, squared=True)
+    else:
+        log_res = kernels.rbf_log_mixture(utils.batch_pdist(X, Y, p), sigmas, degree, weights)
     if log:
-        return log_res / len(sigmas)  # incorrect for log if len(sigmas) > 1
+        return log_res
     else:
-        return utils.min_clamp_prob(ret)
+        return utils.min_clamp_prob(torch.exp(log_res))
 
 def generic_kernel(X, Y, kernel_fn, full=False, log=False):
     if full:
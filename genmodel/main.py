@@ -47,6 +47,9 @@ if __name__ == '__main__':
     arg(parser, 'sigma_decay_start', type=int, default=-1, help='step to start decaying kernel sigma')
     arg(parser, 'sigma_decay_end', type=int, default=-1, help='step to finish decaying kernel sigma')
     arg(parser, 'kernel_degree', type=float, default=2, help='degree for polynomial or cosine kernel')
+    arg(parser, 'rff_features', type=int, default=-1,
+        help='random Fourier features for gaussian kernel (-1 for exact kernel)')
+    arg(parser, 'rff_redraw', type=str, default='step', help='redraw random features every: step, sigma, never')
     arg(parser, 'sinkhorn_eps', type=float, default=1, help='Sinkhorn epislon')
     arg(parser, 'sinkhorn_iters', type=int, default=10, help='Sinkhorn iters')
     arg(parser, 'gen_iters', type=int, default=1, help='no. of generator iters before discriminator update')
@@ -11,16 +11,15 @@ from ..baseadv import BaseAdversarial
 
 sys.path.append('..')
 import gait
-import utils
+import kernels
 
 
 def cosine_kernel(degree=2):
-    return lambda x, y: gait.generic_kernel(x, y, lambda u, v: utils.min_clamp_prob(
-        ((gait.cosine_similarity(u, v) + 1) / 2) ** degree))
+    return kernels.CosineKernel(degree)
 
 
 def gaussian_kernel(sigma):
-    return lambda x, y: gait.generic_kernel(x, y, lambda u, v: gait.rbf_kernel(u, v, sigmas=[sigma], log=True))
+    return kernels.RBFLogKernel(sigma=sigma)
 
 
 class SimilarityCostModel(BaseAdversarial):
@@ -40,6 +39,9 @@ class SimilarityCostModel(BaseAdversarial):
         elif flags.kernel == 'gaussian':
             self.sigma_decay = LinearDecay(flags.sigma_decay_start, flags.sigma_decay_end, flags.kernel_initial_sigma,
                                            flags.kernel_sigma)
+            if flags.rff_features > 0:
+                self.rff = kernels.RandomFourierKernel(num_features=flags.rff_features, orthogonal=True,
+                                                       redraw=flags.rff_redraw)
 
     def loss_function(self, forward_ret, labels=None):
         x_gen, x_real = forward_ret
@@ -53,7 +55,11 @@ class SimilarityCostModel(BaseAdversarial):
 
         if self.flags.kernel == 'gaussian':
             sigma = self.sigma_decay.get_y(self.get_train_steps())
-            self.kernel = gaussian_kernel(sigma)
+            if self.flags.rff_features > 0:
+                self.rff.sigma = sigma
+                self.kernel = self.rff
+            else:
+                self.kernel = gaussian_kernel(sigma)
             D = lambda x, y: gait.breg_mixture_divergence_stable(self.uniform, x, self.uniform, y, self.kernel,
                                                                   symmetric=self.flags.symmetric)
         else:
@@ -67,8 +73,11 @@ class SimilarityCostModel(BaseAdversarial):
             x = v_real[self.batch_size:]
             y_prime = v_gen[:self.batch_size]
             y = v_gen[self.batch_size:]
-            div = D(x, y) + D(x, y_prime) + D(x_prime, y) + \
-                D(x_prime, y_prime) - 2 * D(y, y_prime) - 2 * D(x, x_prime)
+            # D(x, y) + D(x, y') + D(x', y) + D(x', y') - 2 D(y, y') - 2 D(x, x'), from one kernel evaluation
+            divs = gait.breg_mixture_divergences([self.uniform] * 4, [x, x_prime, y, y_prime], self.kernel,
+                                                 [(0, 2), (0, 3), (1, 2), (1, 3), (2, 3), (0, 1)],
+                                                 symmetric=self.flags.symmetric, log=self.flags.kernel == 'gaussian')
+            div = divs[0] + divs[1] + divs[2] + divs[3] - 2 * divs[4] - 2 * divs[5]
 
         if self.train_disc():
             loss = -div + self.flags.gp * self.gradient_penalty(x_real, x_gen)
@@ -10,14 +10,15 @@ from ..basefixed import BaseFixed
 
 sys.path.append('..')
 import gait
+import kernels
 
 
 def gaussian_kernel(sigma):
-    return lambda x, y: gait.generic_kernel(x, y, lambda u, v: gait.rbf_kernel(u, v, sigmas=[sigma], log=True))
+    return kernels.RBFLogKernel(sigma=sigma)
 
 
 def poly_kernel(degree):
-    return lambda x, y: gait.generic_kernel(x, y, lambda u, v: gait.poly_kernel(u, v, degree=degree, log=True))
+    return kernels.PolyLogKernel(degree=degree)
 
 
 class Decoder(nn.Module):
@@ -85,6 +86,9 @@ class FixedModel(BaseFixed):
         if self.flags.kernel == 'gaussian':
             self.sigma_decay = LinearDecay(flags.sigma_decay_start, flags.sigma_decay_end, flags.kernel_initial_sigma,
                                            flags.kernel_sigma)
+            if flags.rff_features > 0:
+                self.rff = kernels.RandomFourierKernel(num_features=flags.rff_features, orthogonal=True,
+                                                       redraw=flags.rff_redraw)
         elif self.flags.kernel == 'poly':
             self.kernel = poly_kernel(self.flags.kernel_degree)
 
@@ -93,10 +97,16 @@ class FixedModel(BaseFixed):
         x = labels.view_as(x_gen)
         if self.flags.kernel == 'gaussian':
             sigma = self.sigma_decay.get_y(self.get_train_steps())
-            self.kernel = gaussian_kernel(sigma)
+            if self.flags.rff_features > 0:
+                self.rff.sigma = sigma
+                self.kernel = self.rff
+            else:
+                self.kernel = gaussian_kernel(sigma)
         D = lambda x, y: gait.breg_mixture_divergence_stable(self.uniform, x, self.uniform, y, self.kernel,
                                                              symmetric=self.flags.symmetric)
         if not self.flags.unbiased:
             return D(x, x_gen)
         else:
-            return 2 * D(x, x_gen) - D(x_gen, x_gen)
+            divs = gait.breg_mixture_divergences([self.uniform] * 2, [x, x_gen], self.kernel, [(0, 1), (1, 1)],
+                                                 symmetric=self.flags.symmetric)
+            return 2 * divs[0] - divs[1]
@@ -0,0 +1,823 @@
+import numpy as np
+import torch
+
+import utils
+
+
+class FusedLogKernelMatvec(torch.autograd.Function):
+    """
+    log(K q) with K[j, i] = exp(log_kernel(X[j], Y[i])), evaluated tile by tile straight from the atom locations.
+    Neither the pairwise distances nor the kernel matrix are stored: backward recomputes every tile and pushes
+    its softmax weights through log_kernel with autograd, one tile at a time.
+    """
+
+    @staticmethod
+    def forward(ctx, X, Y, log_q, log_kernel, tile_size):
+        with torch.no_grad():
+            out = utils.streaming_log_matvec(lambda rows, cols: log_kernel(X[rows], Y[cols]),
+                                             (X.size(0), Y.size(0)), log_q, tile_size)
+        ctx.save_for_backward(X, Y, log_q, out)
+        ctx.log_kernel = log_kernel
+        ctx.tile_size = tile_size
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        X, Y, log_q, out = ctx.saved_tensors
+        log_kernel, tile_size = ctx.log_kernel, ctx.tile_size
+        need_X, need_Y, need_q = ctx.needs_input_grad[:3]
+        shift = torch.where(torch.isinf(out), torch.zeros_like(out), out)
+        grad_X = torch.zeros_like(X) if need_X else None
+        grad_Y = torch.zeros_like(Y) if need_Y else None
+        grad_log_q = torch.zeros_like(log_q) if need_q else None
+        n, m = X.size(0), Y.size(0)
+        for r0 in range(0, n, tile_size):
+            rows = slice(r0, min(r0 + tile_size, n))
+            for c0 in range(0, m, tile_size):
+                cols = slice(c0, min(c0 + tile_size, m))
+                with torch.enable_grad():
+                    X_tile = X[rows].detach().requires_grad_(need_X)
+                    Y_tile = Y[cols].detach().requires_grad_(need_Y)
+                    logits = log_kernel(X_tile, Y_tile)
+                weight = torch.exp(logits.detach()[None, ...] + log_q[:, None, cols] - shift[:, rows, None])
+                weight = weight * grad_out[:, rows, None]
+                if need_q:
+                    grad_log_q[:, cols] += weight.sum(dim=1)
+                inputs = [t for t, need in ((X_tile, need_X), (Y_tile, need_Y)) if need]
+                if inputs:
+                    grads = list(torch.autograd.grad(logits, inputs, weight.sum(dim=0)))
+                    if need_X:
+                        grad_X[rows] += grads.pop(0)
+                    if need_Y:
+                        grad_Y[cols] += grads.pop(0)
+        return grad_X, grad_Y, grad_log_q, None, None
+
+
+def fused_log_kernel_matvec(log_kernel, X, Y, log_q, tile_size=None, out=None):
+    """
+    Memory-bounded log(K q) for a point-cloud kernel, out[b, j] = logsumexp_i(log_kernel(X, Y)[j, i] + log_q[b, i]).
+
+    Inputs:
+        log_kernel [callable] : Function computing the log kernel matrix between two sets of atoms
+        X [n x d tensor] : Locations of the output atoms
+        Y [m x d tensor] : Locations of the atoms of the measure q
+        log_q [batch_size x m tensor] : Log of (batch of) distribution(s) over Y
+        tile_size [int or None] : Tile edge; chosen from utils.LOG_MATVEC_BUDGET when None
+        out [batch_size x n tensor or None] : Output to write into, without gradients only
+    Output:
+        [batch_size x n tensor] log(K q) for each distribution
+    """
+    n, m = X.size(0), Y.size(0)
+    if tile_size is None:
+        tile_size = utils.auto_tile_size(log_q.size(0))
+    if tile_size >= max(n, m):
+        return utils.log_matvec(log_kernel(X, Y), log_q, tile_size, out)
+    if out is not None:
+        return utils.streaming_log_matvec(lambda rows, cols: log_kernel(X[rows], Y[cols]), (n, m), log_q, tile_size,
+                                          out)
+    return FusedLogKernelMatvec.apply(X, Y, log_q, log_kernel, tile_size)
+
+
+def rbf_log_mixture(dist, sigmas, degree=2, weights=None, squared=False):
+    """
+    Log of the mixture of RBF kernels sum_s w_s exp(-(dist / sigma_s)^degree), evaluated for all bandwidths as one
+    broadcasted op on a single distance tensor and combined with a logsumexp.
+    Inputs:
+        dist [n x m tensor] : Pairwise distances, or squared distances if squared
+        sigmas [float, tensor or sequence of floats] : Bandwidths
+        degree [float] : Exponent of the RBF kernel
+        weights [tensor, sequence of floats or None] : Mixture weights, uniform if None
+        squared [boolean] : dist holds squared distances, e.g. from utils.batch_sqdist
+    Output:
+        [n x m tensor] log kernel matrix
+    """
+    sigmas = torch.as_tensor(sigmas, dtype=dist.dtype, device=dist.device).reshape(-1, *([1] * dist.dim()))
+    if squared:
+        logits = -(dist[None, ...] / sigmas ** 2) if degree == 2 else -(dist[None, ...] / sigmas ** 2) ** (degree / 2)
+    else:
+        logits = -(dist[None, ...] / sigmas) ** degree
+    if len(sigmas) == 1:
+        return logits[0]
+    if weights is None:
+        log_w = -np.log(len(sigmas))
+    else:
+        w = torch.as_tensor(weights, dtype=dist.dtype, device=dist.device).reshape(sigmas.shape)
+        log_w = torch.log(w / w.sum())
+    return torch.logsumexp(logits + log_w, 0)
+
+
+class RBFLogKernel:
+    """
+    Log RBF kernel -(||x - y||_p / sigma)^degree, same as gait.rbf_kernel(..., sigmas=[sigma], log=True), or the
+    log of a weighted mixture of bandwidths when sigma is a sequence.
+    Mixture divergences pick up log_matvec and never build the kernel blocks.
+    """
+
+    def __init__(self, sigma=1., p=2, degree=2, tile_size=None, weights=None):
+        self.sigma = sigma
+        self.p = p
+        self.degree = degree
+        self.tile_size = tile_size
+        self.weights = weights
+
+    def __call__(self, X, Y):
+        if self.p == 2:
+            return rbf_log_mixture(utils.batch_sqdist(X, Y), self.sigma, self.degree, self.weights, squared=True)
+        return rbf_log_mixture(utils.batch_pdist(X, Y, self.p), self.sigma, self.degree, self.weights)
+
+    def log_matvec(self, X, Y, log_q, out=None):
+        return fused_log_kernel_matvec(self, X, Y, log_q, self.tile_size, out)
+
+
+class PolyLogKernel:
+    """
+    Log polynomial kernel -degree * log(1 + c * ||x - y||_p), same as gait.poly_kernel(..., log=True).
+    """
+
+    def __init__(self, degree=2, c=1, p=2, tile_size=None):
+        self.degree = degree
+        self.c = c
+        self.p = p
+        self.tile_size = tile_size
+
+    def __call__(self, X, Y):
+        return -torch.log(1 + self.c * utils.batch_pdist(X, Y, self.p)) * self.degree
+
+    def log_matvec(self, X, Y, log_q, out=None):
+        return fused_log_kernel_matvec(self, X, Y, log_q, self.tile_size, out)
+
+
+class CosineKernel:
+    """
+    Shifted cosine kernel ((cos(x, y) + 1) / 2)^degree, clamped away from zero, or its log if log is set.
+    With cache set, the normalised rows of each input are kept and reused for as long as the tensor is unchanged,
+    e.g. for a fixed embedding table.
+    """
+
+    def __init__(self, degree=1, log=False, cache=False, chunk_size=None):
+        self.degree = degree
+        self.log = log
+        self.cache = cache
+        self.chunk_size = chunk_size
+        self._normalized = {}
+
+    def normalize(self, X):
+        if not self.cache:
+            return utils.normalize_rows(X)
+        key = id(X), X._version
+        if key not in self._normalized:
+            if len(self._normalized) >= 8:
+                self._normalized.clear()
+            self._normalized[key] = (X, utils.normalize_rows(X))
+        return self._normalized[key][1]
+
+    def __call__(self, X, Y):
+        X_n = self.normalize(X)
+        Y_n = X_n if Y is X else self.normalize(Y)
+        K = (utils.batch_cosine_similarity(X_n, Y_n, True, self.chunk_size) + 1) / 2
+        if self.log:
+            return self.degree * torch.log(utils.min_clamp_prob(K))
+        return utils.min_clamp_prob(K ** self.degree)
+
+
+class KernelOperator:
+    """
+    Similarity matrix K over an alphabet, applied lazily to (batches of) distributions p of shape
+    [batch_size x *event_shape]. matvec(p) returns p K in the same shape and log_matvec(p) its log, computed
+    stably where the representation allows it. All kernels in this repo are symmetric, so p K = K p.
+    """
+    event_shape = None
+    dtype = None
+    device = None
+
+    @property
+    def event_dims(self):
+        return len(self.event_shape) if self.event_shape is not None else 1
+
+    def matvec(self, p):
+        return torch.exp(self.log_matvec(p))
+
+    def log_matvec(self, p):
+        return torch.log(self.matvec(p))
+
+    def t(self):
+        raise NotImplementedError
+
+    def diagonal(self):
+        return self.to_dense().diagonal().view(*self.event_shape)
+
+    def restrict(self, index):
+        """
+        Kernel over the elements index of a one dimensional alphabet. Representations that can gather the
+        needed entries directly override this; the default densifies.
+        """
+        return DenseKernel(self.to_dense()[index][:, index])
+
+    def to_dense(self):
+        """
+        Dense [N x N] matrix, with N the number of elements of the alphabet, obtained by applying the operator to
+        the standard basis.
+        """
+        N = int(np.prod(self.event_shape))
+        eye = torch.eye(N, dtype=self.dtype, device=self.device).view(N, *self.event_shape)
+        return self.matvec(eye).reshape(N, N)
+
+
+class DenseKernel(KernelOperator):
+    """
+    Dense [n x n] similarity matrix, given either as K or as log_K. Log-domain products of log_K use the tiled
+    utils.log_matvec.
+    """
+
+    def __init__(self, K=None, log_K=None, tile_size=None):
+        assert (K is None) != (log_K is None)
+        self.K = K
+        self.log_K = log_K
+        self.tile_size = tile_size
+        M = K if K is not None else log_K
+        self.event_shape = (M.size(-1),)
+        self.dtype = M.dtype
+        self.device = M.device
+
+    def matvec(self, p):
+        if self.K is None:
+            return torch.exp(self.log_matvec(p))
+        return p @ self.K
+
+    def log_matvec(self, p):
+        if self.log_K is None:
+            return torch.log(self.matvec(p))
+        return utils.log_matvec(self.log_K.t(), torch.log(p), self.tile_size)
+
+    def t(self):
+        if self.K is None:
+            return DenseKernel(log_K=self.log_K.t(), tile_size=self.tile_size)
+        return DenseKernel(self.K.t(), tile_size=self.tile_size)
+
+    def diagonal(self):
+        return self.K.diagonal() if self.K is not None else torch.exp(self.log_K.diagonal())
+
+    def restrict(self, index):
+        if self.K is None:
+            return DenseKernel(log_K=self.log_K[index][:, index], tile_size=self.tile_size)
+        return DenseKernel(self.K[index][:, index], tile_size=self.tile_size)
+
+    def to_dense(self):
+        return self.K if self.K is not None else torch.exp(self.log_K)
+
+
+# per-axis grid kernels, keyed on (size, sigma, degree, dtype, device)
+_GRID_AXIS_CACHE = {}
+
+
+def grid_axis_kernel(size, sigma, degree=2, dtype=None, device=None):
+    """
+    Per-axis kernel exp(-(|x_i - x_j| / sigma)^degree) on a uniform grid of size points in [0, 1], as built by hand
+    for the image kernels in timing.py and the barycenter notebooks. Cached per (size, sigma, degree, dtype,
+    device).
+    Output:
+        K [size x size tensor], log_K [size x size tensor]
+    """
+    dtype = torch.get_default_dtype() if dtype is None else dtype
+    device = torch.device('cpu') if device is None else torch.device(device)
+    key = (size, float(sigma), degree, dtype, device)
+    if key not in _GRID_AXIS_CACHE:
+        x = torch.linspace(0, 1, size, dtype=dtype, device=device)
+        log_K = -(torch.abs(x[:, None] - x[None, :]) / sigma) ** degree
+        _GRID_AXIS_CACHE[key] = (torch.exp(log_K), log_K)
+    return _GRID_AXIS_CACHE[key]
+
+
+def is_toeplitz(K, rtol=1e-5, atol=1e-8):
+    """
+    Whether K[i, j] only depends on j - i, as for a translation-invariant kernel on a uniform grid.
+    """
+    return K.size(0) == K.size(1) and torch.allclose(K[1:, 1:], K[:-1, :-1], rtol=rtol, atol=atol)
+
+
+
+class ToeplitzAxis:
+    """
+    Translation-invariant kernel K[i, j] = t[j - i] along one image axis, applied as x K over the last dimension
+    of x. This is either a zero-padded FFT in O(S log S), a banded convolution truncated where t drops below tol
+    in O(S b), or the dense matmul in O(S^2). With method='auto' the method is picked by a fixed cost model of
+    the axis size S and band b, so the choice (and the round-off of the result) is the same on every machine;
+    pass method explicitly to override it.
+    """
+
+    def __init__(self, K, method='auto', tol=None):
+        assert method in ('auto', 'matmul', 'fft', 'banded')
+        self.K = K
+        self.size = size = K.size(0)
+        self.method = method
+        self.t = torch.cat([K[1:, 0].flip(0), K[0]])  # t[k + size - 1] = t_k
+        # correlation filter of x K, i.e. the flipped t, truncated to the band where it matters
+        self.filter = utils.truncate_filter(self.t.flip(0), tol)
+        self.band = len(self.filter) // 2
+        self._fft_len = 2 * size
+        self._t_fft = None
+
+    def _apply(self, x, method):
+        if method == 'matmul':
+            return x @ self.K
+        if method == 'banded':
+            return utils.convolve1d(x, self.filter)
+        if self._t_fft is None:
+            self._t_fft = torch.fft.rfft(self.t, n=self._fft_len)
+        # the linear convolution x * t, read off where it equals x K
+        y = torch.fft.irfft(torch.fft.rfft(x, n=self._fft_len) * self._t_fft, n=self._fft_len)
+        return y[..., self.size - 1:2 * self.size - 1]
+
+    def _cheapest_method(self):
+        """
+        Method with the lowest estimated cost per row; the constants roughly account for BLAS matmuls running
+        several times faster per flop than the convolution and FFT kernels.
+        """
+        S, L = self.size, self._fft_len
+        costs = {'matmul': S * S, 'banded': 4 * S * (2 * self.band + 1), 'fft': 16 * L * np.log2(L)}
+        return min(costs, key=costs.get)
+
+    def apply(self, x):
+        method = self._cheapest_method() if self.method == 'auto' else self.method
+        return self._apply(x, method)
+
+
+class SeparableKernel(KernelOperator):
+    """
+    Kronecker product K = K_rows (x) K_cols acting on [... x H x W] images, p K = K_rows^T p K_cols, in
+    O(H W (H + W)) instead of O(H^2 W^2). With channels the alphabet is C x H x W and channels do not interact,
+    so a CIFAR batch [batch_size x 3 x 32 x 32] is handled in one call. The log path applies one log-matmul per
+    axis, using the exact per-axis log kernels when given.
+    Translation-invariant (Toeplitz) axes, detected or declared with toeplitz=True, are applied with
+    ToeplitzAxis in matvec, whose output is clamped to be positive; the log path always uses the stable
+    log-matmuls.
+    """
+
+    def __init__(self, K_rows, K_cols=None, log_K_rows=None, log_K_cols=None, channels=None, tile_size=None,
+                 toeplitz=None, method='auto', tol=None):
+        self.K_rows = K_rows
+        self.K_cols = K_rows if K_cols is None else K_cols
+        self.log_K_rows = torch.log(self.K_rows) if log_K_rows is None else log_K_rows
+        if log_K_cols is not None:
+            self.log_K_cols = log_K_cols
+        elif K_cols is None:
+            self.log_K_cols = self.log_K_rows
+        else:
+            self.log_K_cols = torch.log(self.K_cols)
+        self.channels = channels
+        self.tile_size = tile_size
+        self.event_shape = (self.K_rows.size(0), self.K_cols.size(0))
+        if channels is not None:
+            self.event_shape = (channels,) + self.event_shape
+        self.dtype = K_rows.dtype
+        self.device = K_rows.device
+        self.toeplitz = toeplitz
+        self.method = method
+        self.tol = tol
+        self._rows_axis = self._cols_axis = None
+        if method != 'matmul':
+            if toeplitz is None:
+                toeplitz = is_toeplitz(self.K_rows) and is_toeplitz(self.K_cols)
+            if toeplitz:
+                self._rows_axis = ToeplitzAxis(self.K_rows, method, tol)
+                self._cols_axis = ToeplitzAxis(self.K_cols, method, tol)
+
+    @classmethod
+    def from_grid(cls, shape, sigma, channels=None, degree=2, dtype=None, device=None, tile_size=None, method='auto',
+                  tol=None):
+        """
+        Separable RBF kernel on a uniform grid over [0, 1]^2.
+        Inputs:
+            shape [int or (int, int)] : Image size S or (H, W)
+            sigma [float or (float, float)] : Bandwidth, or per-axis bandwidths (sigma_rows, sigma_cols)
+            channels [int or None] : Number of independent channels
+            degree [float] : Exponent of the per-axis kernel
+            method [str] : Per-axis product, one of 'auto', 'matmul', 'fft' or 'banded'
+            tol [float or None] : Relative truncation tolerance of the banded convolution
+        """
+        H, W = (shape, shape) if np.isscalar(shape) else shape
+        sigma_rows, sigma_cols = (sigma, sigma) if np.isscalar(sigma) else sigma
+        K_rows, log_K_rows = grid_axis_kernel(H, sigma_rows, degree, dtype, device)
+        K_cols, log_K_cols = grid_axis_kernel(W, sigma_cols, degree, dtype, device)
+        return cls(K_rows, K_cols, log_K_rows, log_K_cols, channels=channels, tile_size=tile_size, toeplitz=True,
+                   method=method, tol=tol)
+
+    def matvec(self, p):
+        if self._rows_axis is None:
+            return self.K_rows.t() @ p @ self.K_cols
+        res = self._cols_axis.apply(p)
+        # FFT round-off and band truncation leave negative or zero tails where the dense product is tiny but
+        # positive; clamp them so that log(p K) stays finite
+        return utils.clamp_positive(self._rows_axis.apply(res.transpose(-1, -2)).transpose(-1, -2))
+
+    def log_matvec(self, p):
+        H, W = self.event_shape[-2:]
+        batch_shape = p.shape[:-2]
+        log_p = torch.log(p).reshape(-1, W)
+        # contract the columns, then the rows (as columns of the transposed image)
+        res = utils.log_matvec(self.log_K_cols.t(), log_p, self.tile_size).view(-1, H, W)
+        res = res.transpose(-1, -2).reshape(-1, H)
+        res = utils.log_matvec(self.log_K_rows.t(), res, self.tile_size).view(-1, W, H)
+        return res.transpose(-1, -2).reshape(*batch_shape, H, W)
+
+    def t(self):
+        return SeparableKernel(self.K_rows.t(), self.K_cols.t(), self.log_K_rows.t(), self.log_K_cols.t(),
+                               channels=self.channels, tile_size=self.tile_size, toeplitz=self.toeplitz,
+                               method=self.method, tol=self.tol)
+
+    def diagonal(self):
+        diag = self.K_rows.diagonal()[:, None] * self.K_cols.diagonal()[None, :]
+        return diag if self.channels is None else diag.expand(*self.event_shape)
+
+    def to_dense(self):
+        K = torch.kron(self.K_rows, self.K_cols)
+        if self.channels is not None:
+            K = torch.kron(torch.eye(self.channels, dtype=K.dtype, device=K.device), K)
+        return K
+
+
+class LowRankKernel(KernelOperator):
+    """
+    Kernel matrix over an alphabet of n elements factored as K = Phi Phi^T with Phi [n x r], so that products
+    cost O(n r). Products are clamped to be positive, as the factorisation is only approximately non-negative.
+    """
+
+    def __init__(self, features):
+        self.features = features
+        self.event_shape = (features.size(0),)
+        self.dtype = features.dtype
+        self.device = features.device
+
+    def matvec(self, p):
+        return utils.clamp_positive((p @ self.features) @ self.features.t())
+
+    def log_matvec(self, p):
+        return torch.log(self.matvec(p))
+
+    def t(self):
+        return self
+
+    def diagonal(self):
+        return (self.features ** 2).sum(-1)
+
+    def restrict(self, index):
+        return LowRankKernel(self.features[index])
+
+    def to_dense(self):
+        return self.features @ self.features.t()
+
+
+class SparseKernel(KernelOperator):
+    """
+    Sparse [n x n] similarity matrix stored as a torch.sparse COO tensor. Products cost O(batch_size x nnz); the
+    log path is a segmented logsumexp over the stored entries.
+    """
+
+    def __init__(self, K):
+        self.K = K.coalesce()
+        self.event_shape = (self.K.size(-1),)
+        self.dtype = self.K.dtype
+        self.device = self.K.device
+
+    @classmethod
+    def from_knn(cls, log_kernel, X, k, symmetrize=True, chunk_size=None):
+        """
+        Sparse kernel keeping the k largest entries of every row of exp(log_kernel(X, X)), see _from_log_kernel.
+        """
+        k = min(k, X.size(0))
+        return cls._from_log_kernel(log_kernel, X, lambda log_K: log_K >= log_K.topk(k, -1).values[:, -1:],
+                                    symmetrize, chunk_size)
+
+    @classmethod
+    def from_threshold(cls, log_kernel, X, eps, symmetrize=True, chunk_size=None):
+        """
+        Sparse kernel keeping the entries of exp(log_kernel(X, X)) not below eps, see _from_log_kernel.
+        """
+        return cls._from_log_kernel(log_kernel, X, lambda log_K: log_K >= np.log(eps), symmetrize, chunk_size)
+
+    @classmethod
+    def _from_log_kernel(cls, log_kernel, X, keep, symmetrize, chunk_size):
+        """
+        Build the sparse kernel over the atoms X [n x d] one chunk of rows of log_kernel(X, X) at a time, so the
+        dense matrix never exists in full.
+        Inputs:
+            log_kernel [callable] : Log similarity function of two sets of atoms, e.g. RBFLogKernel
+            X [n x d tensor] : Locations of the atoms
+            keep [callable] : Boolean mask of the entries to store, from a chunk of rows of the log kernel
+            symmetrize [boolean] : Store the union of the kept entries and their transposes
+            chunk_size [int or None] : Rows per chunk; chosen from utils.LOG_MATVEC_BUDGET when None
+        Output:
+            [SparseKernel] whose diagonal is always stored, with dropped_mass [n tensor] holding the kernel mass of
+            every row left out of the sparse matrix
+        """
+        n = X.size(0)
+        if chunk_size is None:
+            chunk_size = max(1, utils.LOG_MATVEC_BUDGET // n)
+        rows, cols, log_values, log_mass = [], [], [], []
+        for i in range(0, n, chunk_size):
+            log_K = log_kernel(X[i:i + chunk_size], X)
+            with torch.no_grad():
+                mask = keep(log_K)
+                diag = torch.arange(log_K.size(0), device=X.device)
+                mask[diag, diag + i] = True
+                log_mass.append(torch.logsumexp(log_K, -1))
+            r, c = mask.nonzero(as_tuple=True)
+            rows.append(r + i)
+            cols.append(c)
+            log_values.append(log_K[r, c])
+        rows, cols, values = torch.cat(rows), torch.cat(cols), torch.exp(torch.cat(log_values))
+        if symmetrize:
+            # average duplicates so entries kept from both sides are not counted twice
+            rows, cols, values = torch.cat([rows, cols]), torch.cat([cols, rows]), values.repeat(2)
+            counts = torch.sparse_coo_tensor(torch.stack([rows, cols]), torch.ones_like(values), (n, n)).coalesce()
+        K = torch.sparse_coo_tensor(torch.stack([rows, cols]), values, (n, n)).coalesce()
+        if symmetrize:
+            K = torch.sparse_coo_tensor(K.indices(), K.values() / counts.values(), (n, n))
+        ret = cls(K)
+        with torch.no_grad():
+            kept = torch.zeros(n, dtype=ret.dtype, device=ret.device).index_add(0, ret.K.indices()[0], ret.K.values())
+            ret.dropped_mass = torch.clamp(torch.exp(torch.cat(log_mass)) - kept, min=0)
+        return ret
+
+    def matvec(self, p):
+        return torch.sparse.mm(self.K.t(), p.t()).t()
+
+    def log_matvec(self, p):
+        rows, cols = self.K.indices()
+        terms = torch.log(self.K.values())[None, :] + torch.log(p)[:, rows]
+        index = cols[None, :].expand_as(terms)
+        with torch.no_grad():
+            shift = torch.full_like(p, -np.inf).scatter_reduce(1, index, terms, reduce='amax')
+            shift = torch.where(torch.isinf(shift), torch.zeros_like(shift), shift)
+        total = torch.zeros_like(p).scatter_add(1, index, torch.exp(terms - shift.gather(1, index)))
+        return torch.log(total) + shift
+
+    def t(self):
+        return SparseKernel(self.K.t())
+
+    def diagonal(self):
+        rows, cols = self.K.indices()
+        on_diag = rows == cols
+        return torch.zeros(self.event_shape, dtype=self.dtype, device=self.device).index_add(
+            0, rows[on_diag], self.K.values()[on_diag])
+
+    def restrict(self, index):
+        rows, cols = self.K.indices()
+        position = torch.full((self.K.size(0),), -1, dtype=torch.long, device=self.device)
+        position[index] = torch.arange(len(index), device=self.device)
+        keep = (position[rows] >= 0) & (position[cols] >= 0)
+        indices = torch.stack([position[rows[keep]], position[cols[keep]]])
+        return SparseKernel(torch.sparse_coo_tensor(indices, self.K.values()[keep], (len(index), len(index))))
+
+    def to_dense(self):
+        return self.K.to_dense()
+
+
+class PointCloudKernel(KernelOperator):
+    """
+    Kernel K[i, j] = exp(log_kernel(X_i, Y_j)) between two sets of atoms, evaluated lazily tile by tile with
+    fused_log_kernel_matvec; distributions live on X.
+    """
+
+    def __init__(self, X, log_kernel, Y=None, tile_size=None):
+        self.X = X
+        self.Y = X if Y is None else Y
+        self.log_kernel = log_kernel
+        self.tile_size = tile_size
+        self.event_shape = (X.size(0),)
+        self.dtype = X.dtype
+        self.device = X.device
+
+    def log_matvec(self, p):
+        return fused_log_kernel_matvec(self.log_kernel, self.Y, self.X, torch.log(p), self.tile_size)
+
+    def t(self):
+        return PointCloudKernel(self.Y, self.log_kernel, self.X, self.tile_size)
+
+    def restrict(self, index):
+        return PointCloudKernel(self.X[index], self.log_kernel, self.Y[index], self.tile_size)
+
+    def diagonal(self):
+        tile_size = self.tile_size or utils.auto_tile_size(1)
+        return torch.exp(torch.cat([self.log_kernel(self.X[i:i + tile_size], self.Y[i:i + tile_size]).diagonal()
+                                    for i in range(0, self.X.size(0), tile_size)]))
+
+    def to_dense(self):
+        return torch.exp(self.log_kernel(self.X, self.Y))
+
+
+class CallableKernel(KernelOperator):
+    """
+    Kernel given as a function of the distributions, either fn(p) = p K or log_fn(p) = log(p K), such as the
+    separable image kernel lambda x: Kmat @ x @ Kmat. These act on images by default.
+    """
+
+    def __init__(self, fn=None, log_fn=None, event_shape=None, event_dims=2):
+        assert (fn is None) != (log_fn is None)
+        self.fn = fn
+        self.log_fn = log_fn
+        self.event_shape = event_shape
+        self._event_dims = event_dims
+
+    @property
+    def event_dims(self):
+        return len(self.event_shape) if self.event_shape is not None else self._event_dims
+
+    def matvec(self, p):
+        return self.fn(p) if self.fn is not None else torch.exp(self.log_fn(p))
+
+    def log_matvec(self, p):
+        return self.log_fn(p) if self.log_fn is not None else torch.log(self.fn(p))
+
+    def t(self):  # similarity kernels are symmetric
+        return self
+
+
+class NystromKernel:
+    """
+    Nystrom approximation K ~ C W^+ C^T of a kernel from r landmark atoms, with C = k(Z, L) and W = k(L, L).
+    Landmarks are picked uniformly, by k-means++ seeding or by approximate ridge leverage scores, and the
+    factorisation is returned as features Phi = C W^(-1/2), so that mixture divergences cost O((n+m) r).
+    """
+
+    def __init__(self, kernel, rank, landmarks='uniform', log=False, jitter=1e-6, ridge=1e-3):
+        """
+        Inputs:
+            kernel [callable] : Function to compute the kernel matrix between two sets of atoms
+            rank [int] : Number of landmark atoms r
+            landmarks [str] : One of 'uniform', 'kmeans++' or 'leverage'
+            log [boolean] : kernel returns the log kernel matrix
+            jitter [float] : Relative diagonal loading of W before factorisation
+            ridge [float] : Relative regularisation of the leverage scores
+        """
+        assert landmarks in ('uniform', 'kmeans++', 'leverage')
+        self.kernel = kernel
+        self.rank = rank
+        self.landmarks = landmarks
+        self.log = log
+        self.jitter = jitter
+        self.ridge = ridge
+
+    def _kernel(self, X, Y):
+        K = self.kernel(X, Y)
+        return torch.exp(K) if self.log else K
+
+    def _features(self, Z, L):
+        C = self._kernel(Z, L)
+        W = self._kernel(L, L)
+        W = W + self.jitter * W.diagonal().mean() * torch.eye(W.size(0), dtype=W.dtype, device=W.device)
+        chol = torch.linalg.cholesky(W)
+        return torch.linalg.solve_triangular(chol, C.t(), upper=False).t()
+
+    def select_landmarks(self, Z):
+        """
+        Indices of the landmark atoms among the rows of Z.
+        """
+        N = Z.size(0)
+        r = min(self.rank, N)
+        with torch.no_grad():
+            if self.landmarks == 'uniform' or r == N:
+                return torch.randperm(N, device=Z.device)[:r]
+            if self.landmarks == 'kmeans++':
+                idx = [int(torch.randint(N, (1,)))]
+                d2 = utils.batch_sqdist(Z, Z[idx])[:, 0]
+                for _ in range(r - 1):
+                    if d2.sum() <= 0:  # all remaining atoms duplicate a landmark
+                        break
+                    i = int(torch.multinomial(d2 / d2.sum(), 1))
+                    idx.append(i)
+                    d2 = torch.min(d2, utils.batch_sqdist(Z, Z[i:i + 1])[:, 0])
+                return torch.tensor(idx, device=Z.device)
+            # ridge leverage scores diag(K (K + lambda I)^-1) of a uniform pilot approximation
+            pilot = self._features(Z, Z[torch.randperm(N, device=Z.device)[:r]])
+            gram = pilot.t() @ pilot
+            lda = self.ridge * gram.diagonal().sum() / r
+            gram = gram + lda * torch.eye(r, dtype=Z.dtype, device=Z.device)
+            scores = (pilot * torch.linalg.solve(gram, pilot.t()).t()).sum(-1).clamp(min=0)
+            return torch.multinomial(utils.min_clamp(scores), r, replacement=False)
+
+    def features(self, *supports):
+        """
+        Low-rank features of each set of atoms, sharing one set of landmarks drawn from their union.
+        Inputs:
+            supports [n_i x d tensors] : Locations of the atoms
+        Output:
+            list of [n_i x r tensors] Phi_i with k(Z_i, Z_j) ~ Phi_i Phi_j^T
+        """
+        Z = torch.cat(supports, 0)
+        L = Z[self.select_landmarks(Z)]
+        return list(torch.split(self._features(Z, L), [S.size(0) for S in supports], 0))
+
+    def operator(self, Z):
+        """
+        LowRankKernel over the alphabet of atoms Z, usable in place of a dense K in gait_sim_entropy.
+        """
+        return LowRankKernel(self.features(Z)[0])
+
+    def error_estimate(self, *supports, num_samples=512):
+        """
+        Relative Frobenius error ||K - Phi Phi^T|| / ||K|| of a fresh approximation, on a random subsample of
+        num_samples atoms from the union of supports.
+        """
+        with torch.no_grad():
+            Z = torch.cat(supports, 0)
+            Phi = torch.cat(self.features(*supports), 0)
+            idx = torch.randperm(Z.size(0), device=Z.device)[:num_samples]
+            K = self._kernel(Z[idx], Z[idx])
+            return (torch.norm(K - Phi[idx] @ Phi[idx].t()) / torch.norm(K)).item()
+
+
+class RandomFourierKernel:
+    """
+    Random Fourier features for the RBF kernel exp(-||x - y||^2 / sigma^2) of gait.rbf_kernel with p=2, degree=2,
+    so that K p ~ Phi (Phi^T p) in time linear in the number of atoms. The positive variant uses
+    phi(x) = exp(w.u - ||u||^2) / sqrt(D) with u = sqrt(2) x / sigma, whose products are always positive and
+    hence safe to take logs of; the trigonometric variant sqrt(2 / D) cos(w.x + b) has lower variance but can
+    produce negative estimates.
+    """
+
+    def __init__(self, sigma=1., num_features=1024, orthogonal=False, positive=True, redraw='step'):
+        """
+        Inputs:
+            sigma [float] : Bandwidth of the RBF kernel; can be changed between calls
+            num_features [int] : Number of random features D
+            orthogonal [boolean] : Draw orthogonal random features instead of i.i.d. Gaussian ones
+            positive [boolean] : Use positive random features
+            redraw [str] : Draw new features on every call ('step'), whenever sigma changes ('sigma'), or keep
+                           the first draw and only rescale it by sigma ('never')
+        """
+        assert redraw in ('step', 'sigma', 'never')
+        self.sigma = sigma
+        self.num_features = num_features
+        self.orthogonal = orthogonal
+        self.positive = positive
+        self.redraw = redraw
+        self._omega = None
+        self._phase = None
+        self._drawn_sigma = None
+
+    def resample(self, d, dtype=None, device=None):
+        """
+        Draw new unit-bandwidth frequencies for atoms of dimension d.
+        """
+        D = self.num_features
+        if self.orthogonal:
+            blocks = []
+            for _ in range(-(-D // d)):
+                Q, R = torch.linalg.qr(torch.randn(d, d, dtype=dtype, device=device))
+                # fix the signs of R's diagonal, without which Q is not Haar distributed and the frequency
+                # directions are biased, which the positive features do not average out
+                Q = Q * torch.sign(R.diagonal())
+                # rows rescaled to chi-distributed norms, so that each row is marginally Gaussian
+                blocks.append(Q.t() * torch.randn(d, d, dtype=dtype, device=device).norm(dim=1, keepdim=True))
+            self._omega = torch.cat(blocks, 0)[:D]
+        else:
+            self._omega = torch.randn(D, d, dtype=dtype, device=device)
+        self._phase = 2 * np.pi * torch.rand(D, dtype=dtype, device=device)
+        self._drawn_sigma = self.sigma
+
+    def _draw(self, Z):
+        stale = self._omega is None or self._omega.shape[1] != Z.size(-1) or self._omega.dtype != Z.dtype or \
+            self._omega.device != Z.device
+        if stale or self.redraw == 'step' or (self.redraw == 'sigma' and self.sigma != self._drawn_sigma):
+            self.resample(Z.size(-1), Z.dtype, Z.device)
+
+    def features(self, *supports):
+        """
+        Random features of each set of atoms, sharing one draw of frequencies. Positive features are the exp of
+        log_features and underflow to zero once ||x|| / sigma gets large (around 6 in float32), so log-domain
+        products should use log_features.
+        Inputs:
+            supports [n_i x d tensors] : Locations of the atoms
+        Output:
+            list of [n_i x D tensors] Phi_i with k(Z_i, Z_j) ~ Phi_i Phi_j^T
+        """
+        if self.positive:
+            return [torch.exp(L) for L in self.log_features(*supports)]
+        self._draw(supports[0])
+        D = self.num_features
+        return [np.sqrt(2. / D) * torch.cos(S @ self._omega.t() * (np.sqrt(2) / self.sigma) + self._phase)
+                for S in supports]
+
+    def log_features(self, *supports):
+        """
+        Logs of the positive random features of each set of atoms, sharing one draw of frequencies; finite for
+        atoms of any norm.
+        Inputs:
+            supports [n_i x d tensors] : Locations of the atoms
+        Output:
+            list of [n_i x D tensors] log(Phi_i) with k(Z_i, Z_j) ~ Phi_i Phi_j^T
+        """
+        assert self.positive
+        self._draw(supports[0])
+        res = []
+        for S in supports:
+            u = S * np.sqrt(2) / self.sigma
+            res.append(u @ self._omega.t() - (u ** 2).sum(-1, keepdim=True) - np.log(self.num_features) / 2)
+        return res
+
+    def operator(self, Z):
+        """
+        LowRankKernel over the alphabet of atoms Z, usable in place of a dense K in gait_sim_entropy.
+        """
+        return LowRankKernel(self.features(Z)[0])
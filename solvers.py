@@ -0,0 +1,273 @@
+import numpy as np
+import torch
+
+import gait
+import kernels
+import utils
+
+
+def mirror_descent(objective, q0, max_iter=500, tol=1e-6, step_size=1., shrink=.5, grow=2., min_step=1e-10):
+    """
+    Minimise an objective over the probability simplex by exponentiated gradient (entropic mirror descent) with a
+    backtracking line search, for a batch of independent problems at once. Each problem keeps its own step size,
+    and stops moving once its Frank-Wolfe gap <g, q> - min_i g_i, which bounds the suboptimality of a convex
+    objective, is below tol.
+    Inputs:
+        objective [callable] : Function of q [batch_size x n] returning the [batch_size] losses of the problems
+        q0 [batch_size x n tensor] : Initial distributions; elements outside their support stay at zero
+        max_iter [int] : Maximum number of iterations
+        tol [float] : Frank-Wolfe gap at which a problem is solved
+        step_size [float] : Initial step size
+        shrink [float] : Step size factor after a rejected step
+        grow [float] : Step size factor after an accepted step
+        min_step [float] : Step size below which steps are accepted unconditionally
+    Output:
+        q [batch_size x n tensor] : Solutions
+        gap [batch_size tensor] : Frank-Wolfe gaps of the solutions
+    """
+    q = q0.detach()
+    support = q > 0
+    eta = torch.full((q.size(0), 1), step_size, dtype=q.dtype, device=q.device)
+    loss, grad = _value_and_grad(objective, q)
+    for _ in range(max_iter):
+        gap = _fw_gap(q, grad, support)
+        active = gap > tol
+        if not active.any():
+            break
+        accepted = ~active
+        new_q = q.clone()
+        while not accepted.all():
+            candidate = torch.softmax(torch.log(q) - eta * grad, -1)
+            with torch.no_grad():
+                candidate_loss = objective(candidate)
+            # sufficient decrease in the geometry of the simplex: f(q') <= f(q) + <g, q' - q> + KL(q' || q) / eta
+            kl = torch.where(candidate > 0, candidate * (torch.log(candidate) - torch.log(q)),
+                             torch.zeros_like(candidate)).sum(-1)
+            bound = loss + (grad * (candidate - q)).sum(-1) + kl / eta[:, 0]
+            ok = ~accepted & ((candidate_loss <= bound) | (eta[:, 0] <= min_step))
+            new_q[ok] = candidate[ok]
+            accepted = accepted | ok
+            eta = torch.where(accepted[:, None], eta, eta * shrink)
+        q = new_q
+        eta = torch.where(active[:, None], eta * grow, eta)
+        loss, grad = _value_and_grad(objective, q)
+    return q, _fw_gap(q, grad, support)
+
+
+def _value_and_grad(objective, q):
+    with torch.enable_grad():
+        q = q.detach().requires_grad_()
+        loss = objective(q)
+        grad, = torch.autograd.grad(loss.sum(), q)
+    return loss.detach(), grad
+
+
+def _fw_gap(q, grad, allowed):
+    """
+    Frank-Wolfe gap max_s <g, q - s> over the vertices s of the simplex allowed by the boolean mask.
+    """
+    return (grad * q).sum(-1) - grad.masked_fill(~allowed, float('inf')).min(-1)[0]
+
+
+def frank_wolfe_summary(log_K, p, max_atoms=None, max_iter=100, tol=1e-6, away_steps=True, symmetric=False,
+                        line_search_iter=30):
+    """
+    Sparse summary q of a distribution p minimising the GAIT divergence D(p || q) by (away-step) Frank-Wolfe,
+    starting from the atom with the largest log(p K). Every iteration moves towards a single atom, or away from
+    one in the support, so q has at most one new atom per iteration; once max_atoms are in use only atoms of the
+    support are considered. q K changes by a rank-one term, so log(q K) is updated from one row of the kernel in
+    O(n), and the step size is found by golden section search on those O(n) updates. Each iteration takes one
+    kernel product, of a batch of two vectors, for the gradient.
+    Sparse kernels are rejected: from a single atom log(q K) is -inf outside its neighbourhood, which makes the
+    divergence and its gradient NaN.
+    Inputs:
+        log_K [n x n tensor or kernels.KernelOperator] : Log of positive semi-definite similarity matrix
+        p [1 x n tensor] : Probability distribution over n elements
+        max_atoms [int or None] : Cardinality budget of the summary
+        max_iter [int] : Maximum number of iterations
+        tol [float] : Frank-Wolfe gap at which to stop
+        away_steps [boolean] : Allow steps away from atoms of the support, which can drop them
+        symmetric [boolean] : Use the symmetric version of the divergence
+        line_search_iter [int] : Golden section iterations per step
+    Output:
+        q [1 x n tensor] : Summary distribution
+        log_qK [1 x n tensor] : log(q K)
+        gap [float] : Frank-Wolfe gap of q
+    """
+    K = gait.as_kernel_operator(log_K, log=True)
+    if isinstance(K, kernels.SparseKernel):
+        raise ValueError('frank_wolfe_summary needs a kernel with full support, not a SparseKernel')
+    with torch.no_grad():
+        log_pK = K.log_matvec(p)
+        i = int(torch.argmax(log_pK))
+        q = torch.zeros_like(p)
+        q[0, i] = 1
+        log_qK = _log_row(K, i)[None]
+        for it in range(max_iter + 1):
+            grad = _breg_gradient(K, p, q, log_pK, log_qK, symmetric)
+            support = q > 0
+            full = max_atoms is not None and int(support.sum()) >= max_atoms
+            allowed = support if full else torch.ones_like(support)
+            gap = float(_fw_gap(q, grad, allowed))
+            if gap <= tol or it == max_iter:
+                break
+            grad, inner = grad[0], float((grad * q).sum())
+            s = int(torch.argmin(grad.masked_fill(~allowed[0], float('inf'))))
+            a = int(torch.argmax(grad.masked_fill(~support[0], -float('inf'))))
+            if away_steps and float(grad[a]) - inner > gap and q[0, a] < 1:
+                hi = float(q[0, a] / (1 - q[0, a]))
+                step = _away_step(q, log_qK, a, _log_row(K, a))
+                gamma = _line_search(lambda g: _breg(p, *step(g), log_pK, symmetric), hi, line_search_iter)
+                q, log_qK = step(gamma)
+                if gamma >= hi:  # drop step
+                    q[0, a] = 0
+            else:
+                step = _toward_step(q, log_qK, s, _log_row(K, s))
+                gamma = _line_search(lambda g: _breg(p, *step(g), log_pK, symmetric), 1., line_search_iter)
+                q, log_qK = step(gamma)
+    return q, log_qK, gap
+
+
+def _log_row(K, i):
+    """
+    Row i of the log kernel matrix, i.e. log(e_i K), read directly from dense and point cloud kernels.
+    """
+    if isinstance(K, kernels.DenseKernel):
+        return K.log_K[i] if K.log_K is not None else torch.log(K.K[i])
+    if isinstance(K, kernels.PointCloudKernel):
+        return K.log_kernel(K.X[i:i + 1], K.Y)[0]
+    e = torch.zeros(1, *K.event_shape, dtype=K.dtype, device=K.device)
+    e[0, i] = 1
+    return K.log_matvec(e)[0]
+
+
+def _toward_step(q, log_qK, s, log_row):
+    """
+    q + gamma (e_s - q) and its log(q K), from the log kernel row of atom s.
+    """
+    def step(gamma):
+        gamma = torch.as_tensor(gamma, dtype=q.dtype, device=q.device)
+        new_q = (1 - gamma) * q
+        new_q[0, s] += gamma
+        return new_q, torch.logaddexp(torch.log1p(-gamma) + log_qK, torch.log(gamma) + log_row)
+    return step
+
+
+def _away_step(q, log_qK, a, log_row):
+    """
+    q + gamma (q - e_a) and its log(q K), from the log kernel row of atom a.
+    """
+    def step(gamma):
+        gamma = torch.as_tensor(gamma, dtype=q.dtype, device=q.device)
+        new_q = (1 + gamma) * q
+        new_q[0, a] -= gamma
+        shrink = torch.clamp(-gamma / (1 + gamma) * torch.exp(log_row - log_qK), min=-1 + utils.EPS[q.dtype])
+        return new_q, torch.log1p(gamma) + log_qK + torch.log1p(shrink)
+    return step
+
+
+def _line_search(f, hi, iters):
+    """
+    Golden section search for the minimum of f on [0, hi], also trying the end point hi.
+    """
+    a, b = 0., hi
+    ratio = (np.sqrt(5) - 1) / 2
+    c, d = b - ratio * (b - a), a + ratio * (b - a)
+    fc, fd = f(c), f(d)
+    for _ in range(iters):
+        if fc < fd:
+            b, d, fd = d, c, fc
+            c = b - ratio * (b - a)
+            fc = f(c)
+        else:
+            a, c, fc = c, d, fd
+            d = a + ratio * (b - a)
+            fd = f(d)
+    gamma = (a + b) / 2
+    return hi if f(hi) <= f(gamma) else gamma
+
+
+def _breg(p, q, log_qK, log_pK, symmetric):
+    return float(gait.BregmanDivergence.apply(p, q, log_pK, log_qK, symmetric).sum())
+
+
+def _breg_gradient(K, p, q, log_pK, log_qK, symmetric):
+    """
+    Gradient of D(p || q) with respect to q, through both q and log(q K). The part through log(q K) is a kernel
+    product with a signed vector, taken as the difference of the stable products of its two halves, which are
+    batched into one call.
+    """
+    with torch.enable_grad():
+        q = q.detach().requires_grad_()
+        log_qK = log_qK.detach().requires_grad_()
+        loss = gait.BregmanDivergence.apply(p, q, log_pK, log_qK, symmetric)
+        grad_q, grad_log_qK = torch.autograd.grad(loss.sum(), (q, log_qK))
+    v = grad_log_qK * torch.exp(-log_qK)
+    vK = torch.exp(K.log_matvec(torch.cat([torch.clamp(v, min=0), torch.clamp(-v, min=0)], 0)))
+    return grad_q + vK[:1] - vK[1:]
+
+
+def gait_barycenters(K, sets, labels=None, weights=None, num_steps=500, batch_size=32, lr=0.03, stable=True,
+                     reverse=False, symmetric=False, dtype=None):
+    """
+    GAIT barycenters of several collections of distributions, e.g. one per class, solved as a single batched
+    problem: every step draws a minibatch from each collection and takes one Adam step on the logits of all
+    barycenters at once, so all of them cost about as much as one. The barycenter q_c of collection c minimises
+    the mean divergence D(q_c || p) (D(p || q_c) if reverse) over the distributions p of the collection.
+    Inputs:
+        K [n x n tensor, callable or kernels.KernelOperator] : Similarity matrix, or its log if stable, e.g.
+                                                               kernels.SeparableKernel.from_grid for images
+        sets [list of N_c x *event_shape tensors, or N x *event_shape tensor] : Non-negative samples of each
+                                                                                collection, normalised when drawn
+        labels [N tensor or None] : Collection of every sample when sets is a single tensor; the barycenters
+                                    follow the order of torch.unique(labels)
+        weights [list of N_c tensors or None] : Sampling weights of the samples of each collection
+        num_steps [int] : Number of Adam steps
+        batch_size [int] : Samples drawn from every collection per step
+        lr [float] : Learning rate
+        stable [boolean] : Use breg_sim_divergence_stable with K the log similarity matrix
+        reverse [boolean] : Minimise D(p || q_c) rather than D(q_c || p)
+        symmetric [boolean] : Use symmetrized Bregman divergence
+        dtype [torch.dtype or None] : Compute dtype; dense K is cast to it, operators must already be in it.
+                                      Defaults to the dtype of K, or torch.get_default_dtype() for callables
+    Output:
+        [num_collections x *event_shape tensor] barycenters
+    """
+    if labels is not None:
+        sets = [sets[labels == c] for c in torch.unique(labels)]
+    if isinstance(K, torch.Tensor):
+        K = K.to(dtype or K.dtype)
+    K = gait.as_kernel_operator(K, log=stable)
+    if dtype is None:
+        dtype = K.dtype or torch.get_default_dtype()
+    elif K.dtype is not None and K.dtype != dtype:
+        raise ValueError('K is a %s kernel operator but dtype is %s; build the operator in the compute dtype'
+                         % (K.dtype, dtype))
+    divergence = gait.breg_sim_divergence_stable if stable else gait.breg_sim_divergence
+    shape = tuple(K.event_shape) if K.event_shape is not None else tuple(sets[0].shape[1:])
+    num_sets = len(sets)
+    logits = torch.zeros(num_sets, int(np.prod(shape)), dtype=dtype, device=K.device, requires_grad=True)
+    temp = torch.full((num_sets, 1), .1, dtype=dtype, device=K.device, requires_grad=True)
+    optimizer = torch.optim.Adam([logits, temp], lr=lr, amsgrad=True)
+    for _ in range(num_steps):
+        optimizer.zero_grad()
+        q = torch.softmax(logits / torch.exp(temp), -1)
+        q = q[:, None].expand(-1, batch_size, -1).reshape(num_sets * batch_size, *shape)
+        p = _draw_samples(sets, weights, batch_size, dtype, logits.device).view(num_sets * batch_size, *shape)
+        div = divergence(K, p, q, symmetric=symmetric) if reverse else divergence(K, q, p, symmetric=symmetric)
+        div.view(num_sets, batch_size).mean(1).sum().backward()
+        optimizer.step()
+    with torch.no_grad():
+        return torch.softmax(logits / torch.exp(temp), -1).view(num_sets, *shape)
+
+
+def _draw_samples(sets, weights, batch_size, dtype, device):
+    """
+    [num_sets x batch_size x N] samples drawn with replacement from every set, flattened and normalised to sum to 1.
+    """
+    res = []
+    for i, S in enumerate(sets):
+        w = torch.ones(len(S)) if weights is None else torch.as_tensor(weights[i], dtype=torch.float)
+        res.append(S[torch.multinomial(w, batch_size, replacement=True).to(S.device)].reshape(batch_size, -1))
+    p = torch.abs(torch.stack(res).to(device=device, dtype=dtype))
+    return p / p.sum(-1, keepdim=True)
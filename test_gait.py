@@ -0,0 +1,162 @@
+import numpy as np
+import pytest
+import torch
+
+import gait
+import kernels
+import utils
+
+
+def _reference_divergence(P, Q, log_pK, log_qK, symmetric):
+    """
+    Bregman divergence of breg_sim_divergence written out term by term, differentiated by autograd.
+    """
+    if symmetric:
+        R = (P + Q) / 2.
+        log_rK = torch.log((torch.exp(log_pK) + torch.exp(log_qK)) / 2.)
+        t1 = (P * (log_pK - log_rK)).sum(-1)
+        t2 = (R * torch.exp(log_pK - log_rK)).sum(-1)
+        t3 = (Q * (log_qK - log_rK)).sum(-1)
+        t4 = (R * torch.exp(log_qK - log_rK)).sum(-1)
+        return (2 + t1 - t2 + t3 - t4) / 2.
+    return 1 + (P * (log_pK - log_qK)).sum(-1) - (Q * torch.exp(log_pK - log_qK)).sum(-1)
+
+
+def _inputs(batch_size, n, m, mixture):
+    torch.manual_seed(0)
+    p = torch.softmax(torch.randn(batch_size, n, dtype=torch.float64), -1)
+    q = torch.softmax(torch.randn(batch_size, m if mixture else n, dtype=torch.float64), -1)
+    N = n + m if mixture else n
+    log_pK = torch.randn(batch_size, N, dtype=torch.float64) - 1
+    log_qK = torch.randn(batch_size, N, dtype=torch.float64) - 1
+    return [x.requires_grad_() for x in (p, q, log_pK, log_qK)]
+
+
+@pytest.mark.parametrize('symmetric', [False, True])
+@pytest.mark.parametrize('mixture', [False, True])
+def test_bregman_divergence_matches_reference(symmetric, mixture):
+    p, q, log_pK, log_qK = _inputs(3, 5, 4, mixture)
+    div = gait.BregmanDivergence.apply(p, q, log_pK, log_qK, symmetric, mixture)
+    if mixture:
+        P = torch.cat([p, torch.zeros_like(q)], -1)
+        Q = torch.cat([torch.zeros_like(p), q], -1)
+    else:
+        P, Q = p, q
+    ref = _reference_divergence(P, Q, log_pK, log_qK, symmetric)
+    np.testing.assert_allclose(div.detach().numpy(), ref.detach().numpy(), rtol=1e-10)
+
+    weights = torch.arange(1., 4., dtype=torch.float64)
+    grads = torch.autograd.grad((weights * div).sum(), (p, q, log_pK, log_qK))
+    ref_grads = torch.autograd.grad((weights * ref).sum(), (p, q, log_pK, log_qK))
+    for g, ref_g in zip(grads, ref_grads):
+        np.testing.assert_allclose(g.numpy(), ref_g.numpy(), rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize('symmetric', [False, True])
+@pytest.mark.parametrize('mixture', [False, True])
+def test_bregman_divergence_gradcheck(symmetric, mixture):
+    inputs = _inputs(2, 4, 3, mixture)
+    assert torch.autograd.gradcheck(lambda *x: gait.BregmanDivergence.apply(*x, symmetric, mixture), inputs)
+
+
+@pytest.mark.parametrize('symmetric', [False, True])
+def test_bregman_divergence_mixture_broadcasts(symmetric):
+    p, q, log_pK, log_qK = _inputs(3, 5, 4, True)
+    p1 = p[:1].detach().requires_grad_()
+    div = gait.BregmanDivergence.apply(p1, q, log_pK, log_qK, symmetric, True)
+    ref = gait.BregmanDivergence.apply(p1.expand(3, -1), q, log_pK, log_qK, symmetric, True)
+    grad, = torch.autograd.grad(div.sum(), p1)
+    ref_grad, = torch.autograd.grad(ref.sum(), p1)
+    np.testing.assert_allclose(grad.numpy(), ref_grad.numpy(), rtol=1e-12)
+
+
+def _data_ptrs(workspace):
+    return {key: buf.data_ptr() for key, buf in workspace._buffers.items()}
+
+
+@pytest.mark.parametrize('symmetric', [False, True])
+@pytest.mark.parametrize('fused', [False, True])
+def test_workspace_mixture_divergence_reuses_storage(symmetric, fused):
+    torch.manual_seed(0)
+    Y = torch.randn(5, 2, dtype=torch.float64)
+    X = torch.randn(4, 2, dtype=torch.float64)
+    p = torch.softmax(torch.randn(1, 5, dtype=torch.float64), -1)
+    q = torch.softmax(torch.randn(1, 4, dtype=torch.float64), -1)
+    log_kernel = kernels.RBFLogKernel() if fused else (lambda A, B: -torch.cdist(A, B) ** 2)
+    workspace = gait.DivergenceWorkspace(symmetric=symmetric)
+    ref = gait.breg_mixture_divergence_stable(p, Y, q, X, log_kernel, symmetric=symmetric)
+    ref_log_pK, ref_log_qK = gait._mixture_log_products(p, Y, q, X, log_kernel)
+    with torch.no_grad():
+        workspace.mixture_divergence(p, Y, q, X, log_kernel)
+        data_ptrs = _data_ptrs(workspace)
+        div = workspace.mixture_divergence(p, Y, q, X, log_kernel)
+    np.testing.assert_allclose(div.numpy(), ref.detach().numpy(), rtol=1e-10)
+    # the products, logs and result all live in the same buffers on every call
+    assert _data_ptrs(workspace) == data_ptrs
+    assert div.data_ptr() in data_ptrs.values()
+    log_pK = workspace.buffer('log_pK', (1, 9), torch.float64, p.device)
+    log_qK = workspace.buffer('log_qK', (1, 9), torch.float64, p.device)
+    np.testing.assert_allclose(log_pK.numpy(), ref_log_pK.detach().numpy(), rtol=1e-12)
+    np.testing.assert_allclose(log_qK.numpy(), ref_log_qK.detach().numpy(), rtol=1e-12)
+
+
+@pytest.mark.parametrize('symmetric', [False, True])
+def test_workspace_divergence_reuses_storage(symmetric):
+    torch.manual_seed(0)
+    log_K = -torch.cdist(*2 * [torch.randn(6, 2, dtype=torch.float64)]) ** 2
+    p = torch.softmax(torch.randn(3, 6, dtype=torch.float64), -1)
+    q = torch.softmax(torch.randn(3, 6, dtype=torch.float64), -1)
+    workspace = gait.DivergenceWorkspace(symmetric=symmetric)
+    ref = gait.breg_sim_divergence_stable(log_K, p, q, symmetric=symmetric)
+    with torch.no_grad():
+        workspace.divergence(log_K, p, q)
+        data_ptrs = _data_ptrs(workspace)
+        div = workspace.divergence(log_K, p, q)
+    np.testing.assert_allclose(div.numpy(), ref.numpy(), rtol=1e-10)
+    assert _data_ptrs(workspace) == data_ptrs
+    assert div.data_ptr() in data_ptrs.values()
+    assert {key[0] for key in data_ptrs} >= {'log_p', 'log_q', 'log_pK', 'log_qK'}
+
+
+def test_mixture_target_recomputes_on_new_bandwidth():
+    torch.manual_seed(0)
+    Y = torch.randn(5, 2, dtype=torch.float64)
+    p = torch.softmax(torch.randn(1, 5, dtype=torch.float64), -1)
+    log_kernel = kernels.RBFLogKernel(sigma=1.)
+    target = gait.MixtureTarget(p, Y, log_kernel)
+    target.log_pK()
+    log_kernel.sigma = .5
+    np.testing.assert_allclose(target.log_pK().numpy(), utils.log_matvec(log_kernel(Y, Y), torch.log(p)).numpy(),
+                               rtol=1e-12)
+
+
+@pytest.mark.parametrize('orthogonal', [False, True])
+@pytest.mark.parametrize('positive', [False, True])
+def test_random_fourier_features_approximate_rbf_kernel(orthogonal, positive):
+    torch.manual_seed(0)
+    Z = .2 * torch.randn(6, 3, dtype=torch.float64)
+    rff = kernels.RandomFourierKernel(sigma=1., num_features=20000, orthogonal=orthogonal, positive=positive)
+    Phi, = rff.features(Z)
+    K = gait.rbf_kernel(Z, Z, sigmas=[1.])
+    np.testing.assert_allclose((Phi @ Phi.t()).numpy(), K.numpy(), atol=.06)
+
+
+@pytest.mark.parametrize('alpha', [1., 2.])
+def test_entropy_shapes_match_for_separable_kernels(alpha):
+    torch.manual_seed(0)
+    K = kernels.SeparableKernel.from_grid(6, .2, dtype=torch.float64)
+    p = torch.softmax(torch.randn(3, 36, dtype=torch.float64), -1).view(3, 6, 6)
+    ent = gait.gait_sim_entropy(K, p, alpha)
+    ent_stable = gait.gait_sim_entropy_stable(K, p, alpha)
+    assert ent.shape == ent_stable.shape
+    np.testing.assert_allclose(ent.numpy(), ent_stable.numpy(), rtol=1e-6)
+
+
+def test_entropy_profile_float32_is_smooth_at_the_cutoff():
+    torch.manual_seed(0)
+    log_K = -torch.cdist(*2 * [torch.randn(20, 2, dtype=torch.float64)]) ** 2
+    p = torch.softmax(torch.randn(2, 20, dtype=torch.float64), -1)
+    alphas = 1 + torch.tensor([-1e-2, -5e-3, -1e-3, -1e-4, 0., 1e-4, 1e-3, 5e-3, 1e-2], dtype=torch.float64)
+    ref = gait.gait_sim_entropy_profile_stable(log_K, p, alphas)
+    ent = gait.gait_sim_entropy_profile_stable(log_K.float(), p.float(), alphas.float())
+    np.testing.assert_allclose(ent.double().numpy(), ref.numpy(), atol=1e-4)
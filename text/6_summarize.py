@@ -16,8 +16,10 @@ import argparse
 from pylego.misc import add_argument as arg
 
 from gait import rbf_kernel,\
-    breg_mixture_divergence_stable,\
-    breg_sim_divergence_stable
+    DivergenceTarget,\
+    MixtureTarget
+import kernels
+import solvers
 import utils
 if torch.cuda.is_available():
     device = "cuda"
@@ -46,12 +48,13 @@ def get_summary_movable_locs(words, probs, embs, all_embs, all_words, k=25, scal
     locs = locs.to(device).detach().requires_grad_()
     embs = embs.to(device).detach()
     q_optimizer = optim.Adam([q_logits, locs], lr=1e-4, betas=(0.5, 0.999), amsgrad=False)
+    target = MixtureTarget(p, embs, kernel)
     converged = False
     recent = deque(maxlen=1000)
     step = 0
     while step < 100000 and not converged:
         q = F.softmax(q_logits, dim=1)
-        div = breg_mixture_divergence_stable(p, embs, q, locs, log_kernel=kernel)
+        div = target.divergence(q, locs)
 
         div_item = div.item()
         loss = div
@@ -95,9 +98,17 @@ def get_summary_movable_locs(words, probs, embs, all_embs, all_words, k=25, scal
     return Kq, Kp, q, locs, closest_words
 
 
-def print_summary(words, probs, embs, rbf_sigma=20, rbf=False, cosine_power=1, lda_max=.1, power=.75):
+def print_summary(words, probs, embs, rbf_sigma=20, rbf=False, cosine_power=1, lda_max=.1, power=.75, knn=0,
+                  solver='adam', max_atoms=0):
     p = torch.tensor(np.array(probs, dtype=np.float32)[None, ...])
 
+    if knn > 0:
+        # sparse k-nearest-neighbour kernel, used as a similarity matrix (not as a log kernel as the dense one is)
+        log_kernel = kernels.RBFLogKernel(sigma=rbf_sigma) if rbf else kernels.CosineKernel(cosine_power, log=True)
+        K = kernels.SparseKernel.from_knn(log_kernel, embs.to(device), knn)
+        dropped = K.dropped_mass.sum()
+        print('Kernel mass dropped by the %d-NN graph: %0.4f' % (knn, dropped / (dropped + K.K.values().sum())))
+        return _summarize(words, p, K, lda_max, power, solver, max_atoms)
     if rbf:
         dist = utils.batch_pdist(embs, embs, p=2)
         K = torch.exp(-dist**2/rbf_sigma**2)
@@ -107,15 +118,34 @@ def print_summary(words, probs, embs, rbf_sigma=20, rbf=False, cosine_power=1, l
     plt.imshow(K)
     plt.colorbar()
     # plt.show()
+    return _summarize(words, p, K, lda_max, power, solver, max_atoms)
 
-    Kp = K @ p[0]
+
+def _summarize(words, p, K, lda_max, power, solver='adam', max_atoms=0):
+    p = p.to(device)
+    if isinstance(K, torch.Tensor):
+        K = K.to(device)
+        matvec = lambda x: x @ K.t()
+    else:
+        matvec = K.matvec
+    Kp = matvec(p)[0]
 
     q_logits = torch.zeros_like(p)#(0*torch.randn_like(p)) + torch.log(p)
     #q_logits = q_logits - torch.mean(q_logits)
 
-    p = p.to(device)
-    q_logits = q_logits.to(device).detach().requires_grad_()
-    K = K.to(device)
+    q_logits = q_logits.detach().requires_grad_()
+    target = DivergenceTarget(K, p)
+    if solver == 'mirror':
+        q, gap = solvers.mirror_descent(lambda q: target.divergence(q) + lda_max * torch.norm(q, p=power, dim=-1),
+                                        F.softmax(q_logits, dim=1), max_iter=1000)
+        print('Frank-Wolfe gap: %0.2e' % gap.item())
+        return _summary_products(words, p, q, matvec, Kp)
+    if solver == 'fw':
+        # sparse by construction, so no sparsity penalty
+        q, _, gap = solvers.frank_wolfe_summary(K, p, max_atoms=max_atoms or None, max_iter=500)
+        print('Frank-Wolfe gap: %0.2e with %d atoms' % (gap, (q > 0).sum().item()))
+        return _summary_products(words, p, q, matvec, Kp)
+
     q_optimizer = optim.Adam([q_logits], lr=1e-3, betas=(0.9, 0.999), amsgrad=False)
     converged = False
     recent = deque(maxlen=1000)
@@ -123,7 +153,7 @@ def print_summary(words, probs, embs, rbf_sigma=20, rbf=False, cosine_power=1, l
     while step < 25000 and not converged:
         lda = lda_max*max(min(step/10000., 1.), 0)
         q = F.softmax(q_logits, dim=1)
-        div = breg_sim_divergence_stable(K, p, q)
+        div = target.divergence(q)
         reg = lda * torch.norm(q, p=power)
         div_item = div.item()
         loss = div+reg
@@ -137,7 +167,7 @@ def print_summary(words, probs, embs, rbf_sigma=20, rbf=False, cosine_power=1, l
             print('Step %d: %0.4f; %0.4f' % (step, div_item, loss_item))
             inp = sorted(list(zip(q[0], words)), reverse=True)
             # print('\nSummary:', ['%s %0.2f' % (w, p * 100) for (p, w) in inp])
-            inp = sorted(list(zip((K@q[0]), words)), reverse=True)
+            inp = sorted(list(zip(matvec(q)[0], words)), reverse=True)
             # print('\nSummary:', ['%s %0.2f' % (w, p * 100) for (p, w) in inp])
         recent.append(loss.item())
         loss.backward()
@@ -146,9 +176,13 @@ def print_summary(words, probs, embs, rbf_sigma=20, rbf=False, cosine_power=1, l
         if -np.min(recent) + np.mean(recent) < 1e-4 and step > 15000:
             converged = True
         step += 1
+    return _summary_products(words, p, q, matvec, Kp)
+
+
+def _summary_products(words, p, q, matvec, Kp):
+    Kq = matvec(q)[0]
     q = q[0]
-    Kq = K @ q
-    inp = sorted(list(zip(probs, words)), reverse=True)
+    inp = sorted(list(zip(p[0], words)), reverse=True)
     # print('\nInput:', ['%s %0.2f' % (w, p * 100) for (p, w) in inp])
     inp = sorted(list(zip(Kq, words)), reverse=True)
     # print('\nSummary:', ['%s %0.2f' % (w, p * 100) for (p, w) in inp])
@@ -182,6 +216,9 @@ if __name__ == '__main__':
     arg(parser, 'power', type=float, default=.75, help='Power for p-norm sparsity constraint.')
     arg(parser, 'rbf_sigma', type=float, default=1, help='Scale for RBF kernel, if used.')
     arg(parser, 'lda', type=float, default=.01, help='Upper limit for sparsity objective.')
+    arg(parser, 'knn', type=int, default=0, help='Use a sparse k-nearest-neighbour kernel if positive.')
+    arg(parser, 'solver', type=str, default='adam', help='one of: adam, mirror, fw (fw needs knn=0)')
+    arg(parser, 'max_atoms', type=int, default=0, help='Word budget of Frank-Wolfe summaries, 0 for none.')
 
     flags = parser.parse_args()
     with open('data/news_words', 'rb') as f:
@@ -224,7 +261,8 @@ if __name__ == '__main__':
         print()
 
         Kq, Kp, q = print_summary(words, probs, embs, rbf=flags.rbf, cosine_power=flags.cosine_power, power=flags.power,
-                                  rbf_sigma=flags.rbf_sigma, lda_max=flags.lda)
+                                  rbf_sigma=flags.rbf_sigma, lda_max=flags.lda, knn=flags.knn,
+                                  solver=flags.solver, max_atoms=flags.max_atoms)
 
         count = torch.sum(q > 0.01).int().item()
         reduced = inp[:count]
@@ -1,19 +1,15 @@
 import time
 
-import numpy as np
 import torch
 torch.set_default_tensor_type(torch.DoubleTensor)
 
 import gait
+import kernels
 
 bs, img_size = 100, 128  # TODO loop with batch sizes and produce a plot
 print(f'Considering a batch of {bs} images of size {img_size}x{img_size}.')
 
-[Ygrid, Xgrid] = np.meshgrid(np.linspace(0, 1, img_size), np.linspace(0, 1, img_size))
-Kmat = np.exp(-np.abs(Xgrid - Ygrid)**2/(0.05**2))
-Kmat = torch.tensor(Kmat)
-
-img_kernel = lambda x: torch.matmul(torch.matmul(Kmat, x), Kmat)
+img_kernel = kernels.SeparableKernel.from_grid(img_size, 0.05)
 
 p = torch.softmax(torch.rand(bs, img_size * img_size), dim=1).view(bs, img_size, img_size)
 q = torch.softmax(torch.rand(bs, img_size * img_size), dim=1).view(bs, img_size, img_size)
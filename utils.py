@@ -9,11 +9,150 @@ for dtype in [torch.float16, torch.float32, torch.float64]:
     EPS[dtype] = torch.finfo(dtype).eps * 2
 
 
-def batch_pdist(X, Y, p=2):
-    return torch.norm(X[..., None, :] - Y[..., None, :, :], p=p, dim=-1)
+# Upper bound on the number of elements in the batch x tile x tile temporary of log_matvec.
+LOG_MATVEC_BUDGET = 2 ** 22
 
-def batch_cosine_similarity(X, Y):
-    return torch.cosine_similarity(X[..., None, :], Y[..., None, :, :], dim=-1)
+
+def auto_tile_size(batch):
+    """
+    Largest tile edge for which a batch x tile x tile temporary fits in LOG_MATVEC_BUDGET.
+    """
+    return max(1, int(np.sqrt(LOG_MATVEC_BUDGET / max(batch, 1))))
+
+
+def streaming_log_matvec(log_K_block, shape, log_p, tile_size, out=None):
+    """
+    Running logsumexp of out[b, j] = logsumexp_i(log_K[j, i] + log_p[b, i]) over tile x tile blocks, where
+    log_K_block(rows, cols) returns the requested block of log_K, so log_K itself never has to exist in memory.
+    The result is written into out when given.
+    """
+    n, m = shape
+    batch = log_p.size(0)
+    if out is None:
+        out = log_p.new_empty(batch, n)
+    for r0 in range(0, n, tile_size):
+        rows = slice(r0, min(r0 + tile_size, n))
+        run_max = log_p.new_full((batch, rows.stop - r0), -np.inf)
+        run_sum = log_p.new_zeros(batch, rows.stop - r0)
+        for c0 in range(0, m, tile_size):
+            cols = slice(c0, min(c0 + tile_size, m))
+            block = log_K_block(rows, cols)[None, ...] + log_p[:, None, cols]
+            new_max = torch.max(run_max, block.max(dim=2)[0])
+            shift = torch.where(torch.isinf(new_max), torch.zeros_like(new_max), new_max)
+            run_sum = run_sum * torch.exp(run_max - shift) + torch.exp(block - shift[..., None]).sum(dim=2)
+            run_max = new_max
+        shift = torch.where(torch.isinf(run_max), torch.zeros_like(run_max), run_max)
+        out[:, rows] = torch.log(run_sum) + shift
+    return out
+
+
+class LogMatvec(torch.autograd.Function):
+    """
+    Tiled log(K p) that keeps only log_K, log_p and the output for backward; the tiles of the batch x n x m
+    temporary are recomputed there instead of being stored by autograd.
+    """
+
+    @staticmethod
+    def forward(ctx, log_K, log_p, tile_size):
+        out = streaming_log_matvec(lambda rows, cols: log_K[rows, cols], log_K.shape, log_p, tile_size)
+        ctx.save_for_backward(log_K, log_p, out)
+        ctx.tile_size = tile_size
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        log_K, log_p, out = ctx.saved_tensors
+        tile_size = ctx.tile_size
+        n, m = log_K.shape
+        shift = torch.where(torch.isinf(out), torch.zeros_like(out), out)
+        grad_log_K = torch.zeros_like(log_K) if ctx.needs_input_grad[0] else None
+        grad_log_p = torch.zeros_like(log_p) if ctx.needs_input_grad[1] else None
+        for r0 in range(0, n, tile_size):
+            rows = slice(r0, min(r0 + tile_size, n))
+            for c0 in range(0, m, tile_size):
+                cols = slice(c0, min(c0 + tile_size, m))
+                # d out[b, j] / d log_K[j, i] = d out[b, j] / d log_p[b, i] = softmax weight of (j, i)
+                weight = torch.exp(log_K[None, rows, cols] + log_p[:, None, cols] - shift[:, rows, None])
+                weight = weight * grad_out[:, rows, None]
+                if grad_log_K is not None:
+                    grad_log_K[rows, cols] = weight.sum(dim=0)
+                if grad_log_p is not None:
+                    grad_log_p[:, cols] += weight.sum(dim=1)
+        return grad_log_K, grad_log_p, None
+
+
+def log_matvec(log_K, log_p, tile_size=None, out=None):
+    """
+    Memory-bounded log-domain kernel product, out[b, j] = logsumexp_i(log_K[j, i] + log_p[b, i]).
+    The batch x n x m temporary is streamed over tile x tile blocks with a running logsumexp, so peak memory is
+    O(batch x n + batch x tile^2) in forward and backward.
+
+    Inputs:
+        log_K [n x m tensor] : Log of similarity matrix
+        log_p [batch_size x m tensor] : Log of (batch of) distribution(s), -inf outside the support
+        tile_size [int or None] : Tile edge; chosen from LOG_MATVEC_BUDGET when None
+        out [batch_size x n tensor or None] : Output to write into, without gradients only
+    Output:
+        [batch_size x n tensor] log(K p) for each distribution
+    """
+    n, m = log_K.shape
+    batch = log_p.size(0)
+    if tile_size is None:
+        tile_size = auto_tile_size(batch)
+    if tile_size >= max(n, m):
+        return torch.logsumexp(log_K[None, ...] + log_p[:, None, :], dim=2, out=out)
+    if out is not None:
+        return streaming_log_matvec(lambda rows, cols: log_K[rows, cols], log_K.shape, log_p, tile_size, out)
+    return LogMatvec.apply(log_K, log_p, tile_size)
+
+
+def batch_sqdist(X, Y):
+    """
+    Squared Euclidean distances ||x||^2 + ||y||^2 - 2 x.y via a single matmul, clamped at zero against
+    cancellation, with exact zeros on the diagonal when X is Y. Neither pass forms an n x m x d tensor.
+    """
+    X_sq = (X ** 2).sum(-1, keepdim=True)
+    Y_sq = X_sq if Y is X else (Y ** 2).sum(-1, keepdim=True)
+    sq = torch.clamp(X_sq + Y_sq.transpose(-1, -2) - 2 * X @ Y.transpose(-1, -2), min=0)
+    if Y is X:
+        sq = sq.masked_fill(torch.eye(X.size(-2), dtype=torch.bool, device=X.device), 0)
+    return sq
+
+
+def batch_pdist(X, Y, p=2, chunk_size=None):
+    """
+    Pairwise p-norm distances between the rows of X [... x n x d] and Y [... x m x d]. The Euclidean case goes
+    through batch_sqdist, with a square root whose gradient is zero rather than nan at zero distance; other
+    norms use exact torch.cdist on chunks of rows of X.
+    """
+    if p == 2:
+        sq = batch_sqdist(X, Y)
+        positive = sq > 0
+        return torch.where(positive, torch.sqrt(torch.where(positive, sq, torch.ones_like(sq))), torch.zeros_like(sq))
+    if chunk_size is None:
+        chunk_size = max(1, LOG_MATVEC_BUDGET // (Y.size(-2) * X.size(-1)))
+    return torch.cat([torch.cdist(X[..., i:i + chunk_size, :], Y, p=p) for i in range(0, X.size(-2), chunk_size)],
+                     -2)
+
+def normalize_rows(X, eps=1e-8):
+    """
+    Rows of X scaled to unit L2 norm, with norms below eps clamped as in torch.cosine_similarity.
+    """
+    return X / torch.clamp(X.norm(dim=-1, keepdim=True), min=eps)
+
+
+def batch_cosine_similarity(X, Y, normalized=False, chunk_size=None):
+    """
+    Pairwise cosine similarities between the rows of X [... x n x d] and Y [... x m x d]. Each side is normalised
+    once and the similarities come from a matmul, optionally over chunks of rows of X for large vocabularies.
+    Pass normalized=True when the rows already have unit norm.
+    """
+    if not normalized:
+        X, Y = (normalize_rows(X),) * 2 if Y is X else (normalize_rows(X), normalize_rows(Y))
+    if chunk_size is None or chunk_size >= X.size(-2):
+        return X @ Y.transpose(-1, -2)
+    return torch.cat([X[..., i:i + chunk_size, :] @ Y.transpose(-1, -2) for i in range(0, X.size(-2), chunk_size)],
+                     -2)
 
 def min_clamp_prob(x, c=None):
     if c is None:
@@ -25,6 +164,11 @@ def min_clamp(x, c=None):
         c = EPS[x.dtype]
     return c + x
 
+def clamp_positive(x, c=None):
+    if c is None:
+        c = EPS[x.dtype]
+    return torch.clamp(x, min=c)
+
 def clamp_log_prob(x, c=None):
     return torch.log(min_clamp_prob(x, c))
 
@@ -57,14 +201,35 @@ def sample_and_resize(D, img_size, num_samples=1):
         res.append(sample_img)
     return torch.tensor(res).double()
 
-def convolve(img, filt):
-    # MUCH slower than matmul
-    if len(img.shape) == 3:
-        img = img[:, None, :, :]
-    elif len(img.shape) == 2:
-        img = img[None, None, :, :]
-     
-    filters = filt[None, None, None, :].type_as(img)
-    outconv = F.conv2d(img, filters, padding=[0, len(filt)//2])
-    outconv = F.conv2d(outconv, filters.transpose(-1, -2), padding=[len(filt)//2, 0])
-    return outconv[:, 0, :, :]
+def truncate_filter(filt, tol=None):
+    """
+    Centre of the odd-length filter filt where its magnitude exceeds tol times its maximum.
+    """
+    if tol is None:
+        tol = EPS[filt.dtype]
+    mid = len(filt) // 2
+    above = torch.nonzero(torch.abs(filt) > tol * torch.abs(filt).max())[:, 0] - mid
+    band = int(above.abs().max()) if len(above) else 0
+    return filt[mid - band:mid + band + 1]
+
+
+def convolve1d(x, filt):
+    """
+    Correlate the last dimension of x [... x S] with an odd-length filter, zero-padded to keep size S. All leading
+    dimensions (batch, channels, rows) are folded into the batch of one depthwise conv1d.
+    """
+    shape = x.shape
+    out = F.conv1d(x.reshape(-1, 1, shape[-1]), filt[None, None, :].type_as(x), padding=len(filt) // 2)
+    return out.reshape(shape)
+
+
+def convolve(img, filt, tol=None):
+    """
+    Separable convolution of [... x H x W] images with the odd-length filter filt along both axes. The filter is
+    truncated where it drops below tol (relative), so small-bandwidth Gaussian filters cost O(b) per pixel
+    instead of O(len(filt)). This is always the direct banded convolution; kernels.SeparableKernel chooses
+    between it, an FFT and a dense matmul per axis.
+    """
+    filt = truncate_filter(filt, tol)
+    outconv = convolve1d(img, filt)
+    return convolve1d(outconv.transpose(-1, -2), filt).transpose(-1, -2)